@@ -19,7 +19,8 @@ from active_selection import get_active_selection_class
 import constants
 import sys
 from utils.early_stop import EarlyStopChecker
-from utils.calculate_weights import calculate_weights_labels
+from utils.calculate_weights import calculate_weights_labels, calculate_weights_from_frequencies
+from utils import amp
 
 
 class Trainer(object):
@@ -53,7 +54,11 @@ class Trainer(object):
             raise NotImplementedError
 
         if args.use_balanced_weights:
-            weight = calculate_weights_labels(args.dataset, self.train_loader, self.nclass)
+            if hasattr(self.train_loader.dataset, 'get_class_frequencies'):
+                # running per class totals of the active datasets, no pass over the loader
+                weight = calculate_weights_from_frequencies(self.train_loader.dataset.get_class_frequencies())
+            else:
+                weight = calculate_weights_labels(args.dataset, self.train_loader, self.nclass)
             weight = torch.from_numpy(weight.astype(np.float32))
         else:
             weight = None
@@ -76,6 +81,9 @@ class Trainer(object):
             patch_replication_callback(self.model)
             self.model = self.model.cuda()
 
+        self.device_type = 'cuda' if args.cuda else 'cpu'
+        self.scaler = amp.make_grad_scaler(args.amp, self.device_type)
+
         self.best_pred = 0.0
 
     def training(self, epoch, w_dl, w_un):
@@ -88,6 +96,8 @@ class Trainer(object):
         num_img_tr = len(self.train_loader)
         tbar = tqdm(self.train_loader, desc='\r')
 
+        throughput = amp.ThroughputMeter(self.args.cuda)
+        throughput.start()
         visualization_index = int(random.random() * len(self.train_loader))
         vis_img = None
         vis_tgt_dl = None
@@ -105,7 +115,10 @@ class Trainer(object):
                 self.writer.add_scalar('train/learning_rate', self.scheduler.current_lr, i + num_img_tr * epoch)
 
             self.optimizer.zero_grad()
-            deeplab_output, unet_output = self.model(image)
+            with amp.autocast(self.args.amp, self.device_type):
+                deeplab_output, unet_output = self.model(image)
+            # losses are reduced in float32
+            deeplab_output, unet_output = deeplab_output.float(), unet_output.float()
             unet_target = deeplab_output.argmax(1).squeeze() == deeplab_target.long()
             unet_target[deeplab_target == 255] = 255
 
@@ -119,8 +132,10 @@ class Trainer(object):
             loss_deeplab = self.criterion_deeplab(deeplab_output, deeplab_target)
             loss_unet = self.criterion_unet(unet_output, unet_target)
             loss = w_dl * loss_deeplab + w_un * loss_unet
-            loss.backward()
-            self.optimizer.step()
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            throughput.update(image.shape[0])
             train_loss_deeplab += loss_deeplab.item()
             train_loss_unet += loss_unet.item()
             train_loss += loss.item()
@@ -132,6 +147,9 @@ class Trainer(object):
 
         self.summary.create_single_visualization(self.writer, f'train/run_{self.num_current_labeled_samples:04d}', self.args.dataset, vis_img, vis_tgt_dl, vis_out_dl, vis_tgt_un, vis_out_un, epoch)
 
+        images_per_second, peak_memory_gb = throughput.stop()
+        self.writer.add_scalar('train/images_per_second', images_per_second, epoch)
+        self.writer.add_scalar('train/peak_memory_gb', peak_memory_gb, epoch)
         self.writer.add_scalar('train/total_loss_epoch', train_loss, epoch)
         self.writer.add_scalar('train/total_loss_epoch_dl', train_loss_unet, epoch)
         self.writer.add_scalar('train/total_loss_epoch_un', train_loss_deeplab, epoch)
@@ -179,7 +197,7 @@ class Trainer(object):
                 image, deeplab_target = image.cuda(), deeplab_target.cuda()
 
             with torch.no_grad():
-                deeplab_output, unet_output = self.model(image)
+                deeplab_output, unet_output = amp.forward(self.model, image, self.args.amp, self.device_type)
 
             unet_target = deeplab_output.argmax(1).squeeze() == deeplab_target.long()
             unet_target[deeplab_target == 255] = 255
@@ -201,11 +219,8 @@ class Trainer(object):
 
             tbar.set_description('Test losses: %.2f(dl) + %.2f(un) = %.3f' %
                                  (test_loss_deeplab / (i + 1), test_loss_unet / (i + 1), test_loss / (i + 1)))
-            pred = deeplab_output.data.cpu().numpy()
-            deeplab_target = deeplab_target.cpu().numpy()
-            pred = np.argmax(pred, axis=1)
-            self.deeplab_evaluator.add_batch(deeplab_target, pred)
-            self.unet_evaluator.add_batch(unet_target.cpu().numpy(), np.argmax(unet_output.cpu().numpy(), axis=1))
+            self.deeplab_evaluator.add_batch(deeplab_target, deeplab_output.argmax(1))
+            self.unet_evaluator.add_batch(unet_target, unet_output.argmax(1))
 
         # Fast test during the training
         Acc = self.deeplab_evaluator.Pixel_Accuracy()
@@ -290,6 +305,8 @@ def main():
     parser.add_argument('--nesterov', action='store_true', default=False,
                         help='whether use nesterov (default: False)')
     # cuda, seed and logging
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='mixed precision training and selection, float16 with loss scaling on gpu, bfloat16 on cpu')
     parser.add_argument('--no-cuda', action='store_true', default=False, help='disables CUDA training')
     parser.add_argument('--gpu-ids', type=str, default='0',
                         help='use which gpu to train, must be a \
@@ -323,6 +340,9 @@ def main():
     parser.add_argument('--weight-unet', type=float, default=0.30, help='unet loss weight')
     parser.add_argument('--weight-wrong-label-unet', type=float, default=0.75, help='unet loss weight')
     parser.add_argument('--accuracy-selection', type=str, default='softmax', choices=['softmax', 'argmax'], help='selection based on soft or hard scores')
+    parser.add_argument('--gradient-sensitivity', type=str, default='backward', choices=['backward', 'jvp', 'finite_difference'],
+                        help='exact input gradients or forward-mode / finite difference estimates for gradient selection')
+    parser.add_argument('--gradient-sensitivity-probes', type=int, default=1, help='random directions per batch for jvp and finite difference sensitivity')
     parser.add_argument('--memory-hog', action='store_true', default=False, help='memory_hog mode')
     parser.add_argument('--active-selection-mode', type=str, default='accuracy',
                         choices=['accuracy', 'gradient', 'uncertain', 'uncertain_gradient'], help='method to select new samples')
@@ -399,6 +419,7 @@ def main():
     print()
 
     active_selector = get_active_selection_class('accuracy_labels', training_set.NUM_CLASSES, training_set.env, args.crop_size, args.batch_size)
+    active_selector.set_amp(args.amp)
 
     total_active_selection_iterations = min(len(training_set.image_paths) // args.active_batch_size - 1, args.max_iterations)
 
@@ -475,6 +496,7 @@ def main():
             2], visualizations[3], visualizations[4], len(training_set.current_image_paths))
 
         trainer.writer.close()
+        trainer.saver.flush()
         trainer.model.eval()
 
         if args.active_selection_mode == 'accuracy':
@@ -492,7 +514,7 @@ def main():
         elif args.active_selection_mode == 'gradient':
             print('Estimating gradients..')
             selected_images = active_selector.get_adversarially_vulnarable_samples(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size)
+                trainer.model, training_set.remaining_image_paths, args.active_batch_size, args.gradient_sensitivity, args.gradient_sensitivity_probes)
             training_set.expand_training_set(selected_images)
         elif args.active_selection_mode == 'uncertain':
             print('Estimating uncertainities..')
@@ -505,7 +527,7 @@ def main():
                 trainer.model, training_set.remaining_image_paths, args.active_batch_size * 2)
             print('Estimating gradients..')
             selected_images = active_selector.get_adversarially_vulnarable_samples(
-                trainer.model, selected_images, args.active_batch_size)
+                trainer.model, selected_images, args.active_batch_size, args.gradient_sensitivity, args.gradient_sensitivity_probes)
             training_set.expand_training_set(selected_images)
         torch.cuda.empty_cache()
     writer.close()
@@ -2,18 +2,29 @@ from active_selection.ceal import ActiveSelectionCEAL
 from active_selection.core_set import ActiveSelectionCoreSet
 from active_selection.mc_dropout import ActiveSelectionMCDropout
 from active_selection.max_subset import ActiveSelectionMaxSubset
+from active_selection.kmeans import ActiveSelectionKMeans
 from active_selection.mc_noise import ActiveSelectionMCNoise
 from active_selection.accuracy import ActiveSelectionAccuracy
+from active_selection.projection import FeatureProjector
 
 
-def get_active_selection_class(active_selection_method, dataset_num_classes, dataset_lmdb_env, crop_size, dataloader_batch_size):
+def get_feature_projector(feature_projection, feature_projection_dim):
+    if feature_projection is None or feature_projection == 'none':
+        return None
+    return FeatureProjector(feature_projection, feature_projection_dim)
+
+
+def get_active_selection_class(active_selection_method, dataset_num_classes, dataset_lmdb_env, crop_size, dataloader_batch_size, coreset_half_precision=False,
+                               feature_projection=None, feature_projection_dim=128):
     if active_selection_method == 'coreset':
-        return ActiveSelectionCoreSet(dataset_lmdb_env, crop_size, dataloader_batch_size)
+        selector = ActiveSelectionCoreSet(dataset_lmdb_env, crop_size, dataloader_batch_size, half_precision_features=coreset_half_precision)
+        selector.set_feature_projector(get_feature_projector(feature_projection, feature_projection_dim))
+        return selector
     elif active_selection_method == 'ceal_confidence' or active_selection_method == 'ceal_margin' or active_selection_method == 'ceal_entropy' or active_selection_method == 'ceal_fusion' or active_selection_method == 'ceal_entropy_weakly_labeled':
         return ActiveSelectionCEAL(dataset_num_classes, dataset_lmdb_env, crop_size, dataloader_batch_size)
     elif active_selection_method == 'noise_image' or active_selection_method == 'noise_feature' or active_selection_method == 'noise_variance':
         return ActiveSelectionMCNoise(dataset_num_classes, dataset_lmdb_env, crop_size, dataloader_batch_size)
-    elif active_selection_method == 'variance' or active_selection_method == 'variance_representative' or active_selection_method == 'random':
+    elif active_selection_method == 'variance' or active_selection_method == 'variance_representative' or active_selection_method == 'variance_kmeans' or active_selection_method == 'random':
         return ActiveSelectionMCDropout(dataset_num_classes, dataset_lmdb_env, crop_size, dataloader_batch_size)
     elif active_selection_method == 'accuracy_labels' or active_selection_method == 'accuracy_eval':
         return ActiveSelectionAccuracy(dataset_num_classes, dataset_lmdb_env, crop_size, dataloader_batch_size)
@@ -21,5 +32,15 @@ def get_active_selection_class(active_selection_method, dataset_num_classes, dat
         raise NotImplementedError
 
 
-def get_max_subset_active_selector(dataset_lmdb_env, crop_size, dataloader_batch_size):
-    return ActiveSelectionMaxSubset(dataset_lmdb_env, crop_size, dataloader_batch_size)
+def get_max_subset_active_selector(dataset_lmdb_env, crop_size, dataloader_batch_size, greedy_mode='lazy', distance_dtype='float32', distance_memory_limit_gb=4.0,
+                                   distance_cache_dir=None, feature_projection=None, feature_projection_dim=128):
+    selector = ActiveSelectionMaxSubset(dataset_lmdb_env, crop_size, dataloader_batch_size, greedy_mode=greedy_mode, distance_dtype=distance_dtype,
+                                        distance_memory_limit_gb=distance_memory_limit_gb, distance_cache_dir=distance_cache_dir)
+    selector.set_feature_projector(get_feature_projector(feature_projection, feature_projection_dim))
+    return selector
+
+
+def get_kmeans_active_selector(dataset_lmdb_env, crop_size, dataloader_batch_size, feature_projection=None, feature_projection_dim=128):
+    selector = ActiveSelectionKMeans(dataset_lmdb_env, crop_size, dataloader_batch_size)
+    selector.set_feature_projector(get_feature_projector(feature_projection, feature_projection_dim))
+    return selector
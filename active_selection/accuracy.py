@@ -7,6 +7,7 @@ from tqdm import tqdm
 import os
 import time
 from active_selection.mc_dropout import ActiveSelectionMCDropout
+from utils import selection_handoff
 
 
 class ActiveSelectionAccuracy(ActiveSelectionBase):
@@ -15,23 +16,26 @@ class ActiveSelectionAccuracy(ActiveSelectionBase):
         super(ActiveSelectionAccuracy, self).__init__(dataset_lmdb_env, crop_size, dataloader_batch_size)
         self.num_classes = num_classes
 
+    def _valid_mask(self, label_batch):
+        return (label_batch >= 0) & (label_batch < self.num_classes)
+
     def get_least_accurate_sample_using_labels(self, model, images, selection_count):
 
         model.eval()
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         num_inaccurate_pixels = []
 
         with torch.no_grad():
-            for sample in tqdm(loader):
+            for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
                 image_batch = sample['image'].cuda()
                 label_batch = sample['label'].cuda()
-                output = model(image_batch)
+                output = self._forward(model, image_batch)
                 prediction = torch.argmax(output, dim=1).type(torch.cuda.FloatTensor)
-                for idx in range(prediction.shape[0]):
-                    mask = (label_batch[idx, :, :] >= 0) & (label_batch[idx, :, :] < self.num_classes)
-                    incorrect = label_batch[idx, mask] != prediction[idx, mask]
-                    num_inaccurate_pixels.append(incorrect.sum().cpu().float().item())
+                # one masked reduction and one host copy per batch
+                incorrect = (label_batch != prediction) & self._valid_mask(label_batch)
+                num_inaccurate_pixels.extend(incorrect.sum(dim=(1, 2)).float().cpu().tolist())
 
         selected_samples = list(zip(*sorted(zip(num_inaccurate_pixels, images), key=lambda x: x[0], reverse=True)))[1][:selection_count]
         return selected_samples
@@ -39,79 +43,100 @@ class ActiveSelectionAccuracy(ActiveSelectionBase):
     def get_least_accurate_samples(self, model, images, selection_count, mode='softmax'):
 
         model.eval()
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         num_inaccurate_pixels = []
         softmax = torch.nn.Softmax2d()
         #times = []
         with torch.no_grad():
-            for sample in tqdm(loader):
+            for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
                 image_batch = sample['image'].cuda()
                 label_batch = sample['label'].cuda()
                 #a = time.time()
-                deeplab_output, unet_output = model(image_batch)
+                deeplab_output, unet_output = self._forward(model, image_batch)
 
+                mask = self._valid_mask(label_batch)
                 if mode == 'softmax':
-                    prediction = softmax(unet_output)
-                    for idx in range(prediction.shape[0]):
-                        mask = (label_batch[idx, :, :] >= 0) & (label_batch[idx, :, :] < self.num_classes)
-                        incorrect = prediction[idx, 0, mask]
-                        num_inaccurate_pixels.append(incorrect.sum().cpu().float().item())
+                    incorrect = softmax(unet_output)[:, 0, :, :]
                 elif mode == 'argmax':
-                    prediction = unet_output.argmax(1).squeeze().type(torch.cuda.FloatTensor)
-                    for idx in range(prediction.shape[0]):
-                        mask = (label_batch[idx, :, :] >= 0) & (label_batch[idx, :, :] < self.num_classes)
-                        incorrect = 1 - prediction[idx, mask]
-                        num_inaccurate_pixels.append(incorrect.sum().cpu().float().item())
+                    incorrect = 1 - unet_output.argmax(1).type(torch.cuda.FloatTensor)
                 else:
                     raise NotImplementedError
+                num_inaccurate_pixels.extend(torch.where(mask, incorrect, torch.zeros_like(incorrect)).sum(dim=(1, 2)).float().cpu().tolist())
                 #times.append(time.time() - a)
         #print(np.mean(times), np.std(times))
         selected_samples = list(zip(*sorted(zip(num_inaccurate_pixels, images), key=lambda x: x[0], reverse=True)))[1][:selection_count]
         return selected_samples
 
-    def get_adversarially_vulnarable_samples(self, model, images, selection_count):
+    @staticmethod
+    def _gradient_sensitivity(unet, unet_input, mode='backward', num_probes=1, epsilon=1e-3):
+        # backward: per pixel norm of the input gradient of the summed unet output, like before.
+        # jvp / finite_difference: per pixel norm of the output change along random input directions, averaged over
+        # probes. Neither keeps a backward graph, so larger batches fit in the same memory
+        if mode == 'backward':
+            unet_input = unet_input.detach().requires_grad_()
+            gradient, = torch.autograd.grad(unet(unet_input).sum(), unet_input)
+            return torch.norm(gradient, p=2, dim=1)
+        if mode == 'jvp':
+            try:
+                from torch.func import jvp
+            except ImportError:
+                raise NotImplementedError
+        elif mode != 'finite_difference':
+            raise NotImplementedError
+        unet_input = unet_input.detach()
+        sensitivity = 0
+        with torch.no_grad():
+            if mode == 'finite_difference':
+                base_output = unet(unet_input)
+            for _ in range(num_probes):
+                direction = torch.randn_like(unet_input)
+                if mode == 'jvp':
+                    _, output_change = jvp(unet, (unet_input,), (direction,))
+                else:
+                    output_change = (unet(unet_input + epsilon * direction) - base_output) / epsilon
+                sensitivity = sensitivity + torch.norm(output_change, p=2, dim=1)
+        return sensitivity / num_probes
+
+    def get_adversarially_vulnarable_samples(self, model, images, selection_count, mode='backward', num_probes=1):
         model.eval()
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
 
         softmax = torch.nn.Softmax2d()
         scores = []
-        for sample in tqdm(loader):
+        for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
             image_batch = sample['image'].cuda()
             label_batch = sample['label'].cuda()
             with torch.no_grad():
-                deeplab_output, unet_output = model(image_batch)
-            prediction = softmax(unet_output)
-            unet_input = torch.cuda.FloatTensor(torch.cat([softmax(deeplab_output), image_batch], dim=1).detach().cpu().numpy())
-            unet_input.requires_grad = True
-            only_unet_output = model.module.unet(unet_input)
-            only_unet_output.backward(torch.ones_like(only_unet_output).cuda())
-            gradient_norms = torch.norm(unet_input.grad, p=2, dim=1)
-            for idx in range(prediction.shape[0]):
-                mask = (label_batch[idx, :, :] < 0) | (label_batch[idx, :, :] >= self.num_classes)
-                gradient_norms[idx, mask] = 0
-                scores.append(gradient_norms[idx, :, :].mean().cpu().float().item())
+                deeplab_output, _ = self._forward(model, image_batch)
+                unet_input = torch.cat([softmax(deeplab_output), image_batch], dim=1)
+            gradient_norms = self._gradient_sensitivity(model.module.unet, unet_input, mode, num_probes)
+            gradient_norms = torch.where(self._valid_mask(label_batch), gradient_norms, torch.zeros_like(gradient_norms))
+            scores.extend(gradient_norms.mean(dim=(1, 2)).float().cpu().tolist())
         selected_samples = list(zip(*sorted(zip(scores, images), key=lambda x: x[0], reverse=True)))[1][:selection_count]
         return selected_samples
 
     def get_unsure_samples(self, model, images, selection_count):
         model.eval()
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
 
         softmax = torch.nn.Softmax2d()
         scores = []
         with torch.no_grad():
-            for sample in tqdm(loader):
+            for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
                 image_batch = sample['image'].cuda()
                 label_batch = sample['label'].cuda()
-                deeplab_output, unet_output = model(image_batch)
+                deeplab_output, unet_output = self._forward(model, image_batch)
                 prediction = softmax(unet_output)
-                for idx in range(prediction.shape[0]):
-                    mask = (label_batch[idx, :, :] >= 0) & (label_batch[idx, :, :] < self.num_classes)
-                    y = 4 * prediction[idx, 1, mask] - 4 * prediction[idx, 1, mask] ** 2
-                    scores.append(y.mean().cpu().float().item())
+                mask = self._valid_mask(label_batch).float()
+                y = 4 * prediction[:, 1, :, :] - 4 * prediction[:, 1, :, :] ** 2
+                # mean over valid pixels, nan for images without any like the masked mean before
+                scores.extend(((y * mask).sum(dim=(1, 2)) / mask.sum(dim=(1, 2))).float().cpu().tolist())
         selected_samples = list(zip(*sorted(zip(scores, images), key=lambda x: x[0], reverse=True)))[1][:selection_count]
         print(scores)
         return selected_samples
@@ -129,6 +154,8 @@ class ActiveSelectionAccuracy(ActiveSelectionBase):
                 score_map[zero_out_mask] = 0
 
     def get_least_accurate_region_maps(self, model, images, existing_regions, region_size, selection_size):
+        order = self._pool_order(len(images))
+        images, existing_regions = [images[i] for i in order], [existing_regions[i] for i in order]
         base_size = 512 if self.crop_size == -1 else self.crop_size
         score_maps = torch.cuda.FloatTensor(len(images), base_size - region_size + 1, base_size - region_size + 1)
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
@@ -142,12 +169,12 @@ class ActiveSelectionAccuracy(ActiveSelectionBase):
         #base_images = []
         softmax = torch.nn.Softmax2d()
         with torch.no_grad():
-            for sample in tqdm(loader):
+            for sample in self._budgeted(tqdm(loader), 'region scoring', len(loader)):
                 image_batch = sample['image'].cuda()
                 label_batch = sample['label'].cuda()
 
                 #a = time.time()
-                deeplab_output, unet_output = model(image_batch)
+                deeplab_output, unet_output = self._forward(model, image_batch)
                 prediction = softmax(unet_output)
                 for idx in range(prediction.shape[0]):
                     mask = (label_batch[idx, :, :] < 0) | (label_batch[idx, :, :] >= self.num_classes)
@@ -160,6 +187,7 @@ class ActiveSelectionAccuracy(ActiveSelectionBase):
                         0).unsqueeze(0), weights.unsqueeze(0).unsqueeze(0)).squeeze().squeeze()
                     map_ctr += 1
                 #times.append(time.time() - a)
+        score_maps = score_maps[:map_ctr]
         min_val = score_maps.min()
         max_val = score_maps.max()
         minmax_norm = lambda x: x.add_(-min_val).mul_(1.0 / (max_val - min_val))
@@ -167,7 +195,7 @@ class ActiveSelectionAccuracy(ActiveSelectionBase):
 
         num_requested_indices = (selection_size * base_size * base_size) / (region_size * region_size)
         #print(np.mean(times), np.std(times))
-        regions, num_selected_indices = ActiveSelectionMCDropout.square_nms(score_maps.cpu(), region_size, num_requested_indices)
+        regions, num_selected_indices = ActiveSelectionMCDropout.square_nms(score_maps.cpu(), region_size, num_requested_indices, self.time_budget)
         # print(f'Requested/Selected indices {num_requested_indices}/{num_selected_indices}')
 
         # for i in range(len(regions)):
@@ -184,14 +212,12 @@ class ActiveSelectionAccuracy(ActiveSelectionBase):
 
     def wait_for_selected_samples(self, location_to_monitor, images):
 
-        while True:
-            if os.path.exists(location_to_monitor):
-                break
-            time.sleep(5)
+        selection_handoff.wait_for_publish(location_to_monitor)
 
         paths = []
         with open(location_to_monitor, "r") as fptr:
-            paths = [u'{}'.format(x.strip()).encode('ascii') for x in fptr.readlines() if x is not '']
+            paths = [u'{}'.format(x.strip()).encode('ascii') for x in fptr.readlines() if x.strip() != '']
 
-        selected_samples = [x for x in paths if x in images]
+        remaining = set(images)
+        selected_samples = [x for x in paths if x in remaining]
         return selected_samples
@@ -1,6 +1,70 @@
+import random
+
+
 class ActiveSelectionBase:
 
     def __init__(self, dataset_lmdb_env, crop_size, dataloader_batch_size):
         self.crop_size = crop_size
         self.dataloader_batch_size = dataloader_batch_size
         self.env = dataset_lmdb_env
+        self.feature_projector = None
+        self.feature_store = None
+        self.ann_backend = None
+        self.time_budget = None
+        self.amp = False
+        self.pool_random = random.Random(0)
+
+    def set_amp(self, enabled):
+        self.amp = enabled
+
+    def _forward(self, model, inputs):
+        # mixed precision forward when enabled, outputs are always float32
+        from utils.amp import forward
+        return forward(model, inputs, self.amp)
+
+    def set_time_budget(self, time_budget):
+        self.time_budget = time_budget
+
+    def _budgeted(self, iterable, stage, total):
+        if self.time_budget is None:
+            return iterable
+        return self.time_budget.iterate(iterable, stage, total)
+
+    def _pool_order(self, num_images):
+        # under a time budget the pool is visited in a random order, so that a pass cut short scores a uniform
+        # subsample instead of the first images. The order changes every call, so that images left out by one
+        # iteration are scored by the next ones
+        order = list(range(num_images))
+        if self.time_budget is not None:
+            self.pool_random.shuffle(order)
+        return order
+
+    def set_ann_config(self, backend, n_lists=None, nprobe=8, neighbors=20, recall_sample_size=256):
+        # approximate nearest neighbour search for the diversity selectors, backend None keeps exact distances
+        self.ann_backend = backend
+        self.ann_lists = n_lists
+        self.ann_nprobe = nprobe
+        self.ann_neighbors = neighbors
+        self.ann_recall_sample_size = recall_sample_size
+
+    def _build_ann_index(self, data, queries, k=1):
+        from utils.ann import build_ann_index, measure_recall
+
+        index = build_ann_index(self.ann_backend, data, n_lists=self.ann_lists, nprobe=self.ann_nprobe)
+        measure_recall(index, queries, k=k, sample_size=self.ann_recall_sample_size)
+        return index
+
+    def set_feature_store(self, feature_store):
+        self.feature_store = feature_store
+
+    def set_feature_projector(self, feature_projector):
+        self.feature_projector = feature_projector
+
+    def _reset_feature_projector(self):
+        if self.feature_projector is not None:
+            self.feature_projector.reset()
+
+    def _project_feature_batches(self, feature_batches):
+        if self.feature_projector is None:
+            return feature_batches
+        return self.feature_projector.project(feature_batches)
@@ -0,0 +1,47 @@
+import time
+
+
+class SelectionBudget:
+    """Wall clock budget shared by the selectors of one active iteration.
+
+    Loops wrapped with iterate() stop when the budget runs out, after at least min_items items, so that selectors
+    return what they have so far: scores of a (shuffled) subsample of the pool or a prefix of a greedy selection.
+    Every wrapped loop is recorded with the fraction it completed.
+    """
+
+    def __init__(self, seconds, min_items=1):
+        self.seconds = seconds
+        self.min_items = min_items
+        self.start_time = None
+        self.stages = []
+
+    def start(self):
+        self.start_time = time.time()
+        self.stages = []
+
+    def exceeded(self):
+        return self.start_time is not None and time.time() - self.start_time > self.seconds
+
+    def iterate(self, iterable, stage, total):
+        completed = 0
+        exhausted = False
+        try:
+            for item in iterable:
+                if completed >= self.min_items and self.exceeded():
+                    print(f'Selection time budget of {self.seconds}s exhausted in {stage} after {completed}/{total}')
+                    exhausted = True
+                    break
+                yield item
+                completed += 1
+        finally:
+            # loops that stop early on their own (e.g. nms running out of scores) count as complete
+            self.stages.append({'stage': stage, 'completed': completed, 'total': total, 'budget_exhausted': exhausted,
+                                'fraction': completed / total if exhausted and total > 0 else 1.0})
+
+    def report(self):
+        return {
+            'budget_seconds': self.seconds,
+            'elapsed_seconds': time.time() - self.start_time if self.start_time is not None else 0,
+            'achieved_fraction': min([stage['fraction'] for stage in self.stages]) if len(self.stages) > 0 else 1.0,
+            'stages': self.stages
+        }
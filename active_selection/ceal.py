@@ -18,6 +18,7 @@ class ActiveSelectionCEAL(ActiveSelectionBase):
 
     def get_least_confident_samples(self, model, images, selection_count):
         model.eval()
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         max_confidence = []
@@ -28,11 +29,11 @@ class ActiveSelectionCEAL(ActiveSelectionBase):
         #lc_images = []
 
         with torch.no_grad():
-            for sample in tqdm(loader):
+            for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
                 image_batch = sample['image'].cuda()
                 label_batch = sample['label'].cuda()
                 softmax = torch.nn.Softmax2d()
-                output = model(image_batch)
+                output = self._forward(model, image_batch)
                 max_conf_batch = torch.max(softmax(output), dim=1)[0]
                 for batch_idx in range(max_conf_batch.shape[0]):
                     mask = (label_batch[batch_idx, :, :] < 0) | (label_batch[batch_idx, :, :] >= self.dataset_num_classes)
@@ -71,15 +72,16 @@ class ActiveSelectionCEAL(ActiveSelectionBase):
 
     def get_least_margin_samples(self, model, images, selection_count):
         model.eval()
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         margins = []
         with torch.no_grad():
-            for sample in tqdm(loader):
+            for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
                 image_batch = sample['image'].cuda()
                 label_batch = sample['label'].cuda()
                 softmax = torch.nn.Softmax2d()
-                output = softmax(model(image_batch))
+                output = softmax(self._forward(model, image_batch))
                 for batch_idx in range(output.shape[0]):
                     mask = (label_batch[batch_idx, :, :] < 0) | (label_batch[batch_idx, :, :] >= self.dataset_num_classes)
                     mask = mask.cpu().numpy().astype(np.bool)
@@ -98,18 +100,21 @@ class ActiveSelectionCEAL(ActiveSelectionBase):
         return selected_samples
 
     def _get_entropies(self, model, images):
+        # entropies are aligned with images, images not reached within the time budget get None
         model.eval()
-        loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
+        order = self._pool_order(len(images))
+        ordered_images = [images[i] for i in order]
+        loader = DataLoader(paths_dataset.PathsDataset(self.env, ordered_images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         entropies = []
         #times = []
         with torch.no_grad():
-            for sample in tqdm(loader):
+            for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
                 image_batch = sample['image'].cuda()
                 label_batch = sample['label'].cuda()
                 #a = time.time()
                 softmax = torch.nn.Softmax2d()
-                output = softmax(model(image_batch))
+                output = softmax(self._forward(model, image_batch))
                 num_classes = output.shape[1]
                 for batch_idx in range(output.shape[0]):
                     mask = (label_batch[batch_idx, :, :] < 0) | (label_batch[batch_idx, :, :] >= self.dataset_num_classes)
@@ -123,11 +128,15 @@ class ActiveSelectionCEAL(ActiveSelectionBase):
                     entropies.append(np.mean(entropy_map.cpu().numpy()))
                 #times.append(time.time() - a)
         ##print(np.mean(times), np.std(times))
-        return entropies
+        aligned_entropies = [None] * len(images)
+        for i, entropy in zip(order, entropies):
+            aligned_entropies[i] = entropy
+        return aligned_entropies
 
     def get_maximum_entropy_samples(self, model, images, selection_count):
         entropies = self._get_entropies(model, images)
-        selected_samples = list(zip(*sorted(zip(entropies, images), key=lambda x: x[0], reverse=True)))[1][:selection_count]
+        scored = [(entropy, image) for entropy, image in zip(entropies, images) if entropy is not None]
+        selected_samples = list(zip(*sorted(scored, key=lambda x: x[0], reverse=True)))[1][:selection_count]
         return selected_samples, entropies
 
     def get_fusion_of_confidence_margin_entropy_samples(self, model, images, selection_count):
@@ -145,7 +154,7 @@ class ActiveSelectionCEAL(ActiveSelectionBase):
         selected_images = []
         weak_labels = []
         for image, entropy in zip(images, entropies):
-            if entropy < threshold:
+            if entropy is not None and entropy < threshold:
                 selected_images.append(image)
 
         loader = DataLoader(paths_dataset.PathsDataset(self.env, selected_images, self.crop_size, include_labels=True),
@@ -155,7 +164,7 @@ class ActiveSelectionCEAL(ActiveSelectionBase):
             for sample in tqdm(loader):
                 image_batch = sample['image'].cuda()
                 label_batch = sample['label'].cuda()
-                output = model(image_batch)
+                output = self._forward(model, image_batch)
                 for batch_idx in range(output.shape[0]):
                     mask = (label_batch[batch_idx, :, :] < 0) | (label_batch[batch_idx, :, :] >= self.dataset_num_classes)
                     mask = mask.cpu().numpy().astype(np.bool)
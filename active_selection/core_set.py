@@ -3,67 +3,189 @@ from torch.utils.data import DataLoader
 import torch.nn.functional as F
 import torch
 import numpy as np
-from sklearn.metrics import pairwise_distances
 from active_selection.base import ActiveSelectionBase
+from utils.distances import get_distance_device, to_feature_tensor, squared_norms, update_min_distances
 from tqdm import tqdm
 import time
+import os
 
 
 class ActiveSelectionCoreSet(ActiveSelectionBase):
 
-    def __init__(self,  dataset_lmdb_env, crop_size, dataloader_batch_size):
+    def __init__(self, dataset_lmdb_env, crop_size, dataloader_batch_size, half_precision_features=False, distance_block_size=2048):
         super(ActiveSelectionCoreSet, self).__init__(dataset_lmdb_env, crop_size, dataloader_batch_size)
+        self.half_precision_features = half_precision_features
+        self.distance_block_size = distance_block_size
+        self.static_embedding = None
+
+    def set_static_embedding(self, static_embedding, embedding_path, embedding_model=None):
+        """Use a fixed embedding, 'initial' (the first model selections are made with) or 'imagenet' (the pretrained
+        backbone in embedding_model), persisted at embedding_path. Distances to the labeled set are then kept across
+        iterations and only newly labeled images are folded in."""
+        assert static_embedding in ['initial', 'imagenet'], 'unknown static embedding'
+        self.static_embedding = static_embedding
+        self.static_embedding_path = embedding_path
+        self.embedding_model = embedding_model
+        self.static_path_to_index = None
+        self.static_features = None
+        self.static_feature_norms = None
+        self.static_min_distances = None
+        self.static_centers = set()
 
     def _select_batch(self, features, selected_indices, N):
+        # a pass cut short by the time budget may leave fewer candidates than requested picks
+        N = min(N, len(features) - len(selected_indices))
+        if N <= 0:
+            return []
+        use_ann = self.ann_backend is not None and len(selected_indices) > 0
+        approximate_min_distances = self._approximate_min_distances(features, selected_indices) if use_ann else None
+        features = to_feature_tensor(features, get_distance_device(), self.half_precision_features)
+        feature_norms = squared_norms(features, self.distance_block_size)
         new_batch = []
-        min_distances = self._updated_distances(selected_indices, features, None)
+        if use_ann:
+            min_distances = approximate_min_distances.to(features.device)
+        else:
+            min_distances = self._updated_distances(selected_indices, features, feature_norms, None)
+        selected = set(selected_indices)
 
-        for _ in range(N):
-            ind = np.argmax(min_distances)
+        for _ in self._budgeted(range(N), 'k-center greedy', N):
+            ind = torch.argmax(min_distances).item()
             # New examples should not be in already selected since those points
             # should have min_distance of zero to a cluster center.
-            assert ind not in selected_indices
-            min_distances = self._updated_distances([ind], features, min_distances)
+            assert ind not in selected
+            min_distances = self._updated_distances([ind], features, feature_norms, min_distances)
             new_batch.append(ind)
+            selected.add(ind)
 
-        print('Maximum distance from cluster centers is %0.5f' % max(min_distances))
+        print('Maximum distance from cluster centers is %0.5f' % min_distances.max().item())
         return new_batch
 
-    def _updated_distances(self, cluster_centers, features, min_distances):
-        x = features[cluster_centers, :]
-        dist = pairwise_distances(features, x, metric='euclidean')
+    def _approximate_min_distances(self, features, selected_indices):
+        # distance to the closest labeled center from an ANN index over the centers instead of all N x labeled pairs,
+        # a missed neighbour only overestimates the distance. Newly picked centers are still folded in exactly
+        features = np.asarray(features, dtype=np.float32)
+        index = self._build_ann_index(features[selected_indices], features)
+        distances, _ = index.query(features, k=1)
+        min_distances = torch.from_numpy(distances[:, 0].copy())
+        min_distances[torch.as_tensor(selected_indices, dtype=torch.long)] = 0
+        return min_distances
+
+    def _updated_distances(self, cluster_centers, features, feature_norms, min_distances):
         if min_distances is None:
-            return np.min(dist, axis=1).reshape(-1, 1)
-        else:
-            return np.minimum(min_distances, dist)
+            min_distances = torch.full((features.shape[0],), float('inf'), dtype=torch.float32, device=features.device)
+        return update_min_distances(features, feature_norms, cluster_centers, min_distances, self.distance_block_size)
 
     def get_k_center_greedy_selections(self, selection_size, model, candidate_image_batch, already_selected_image_batch):
+        if self.static_embedding is not None:
+            return self._get_static_k_center_greedy_selections(selection_size, model, candidate_image_batch, already_selected_image_batch)
+        candidate_image_batch = [candidate_image_batch[i] for i in self._pool_order(len(candidate_image_batch))]
         combined_paths = already_selected_image_batch + candidate_image_batch
-        loader = DataLoader(paths_dataset.PathsDataset(self.env, combined_paths, self.crop_size),
-                            batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         if model.module.model_name == 'deeplab':
-            FEATURE_DIM = 2736
             average_pool_kernel_size = (64, 64)
         elif model.module.model_name == 'enet':
-            FEATURE_DIM = 1152
             average_pool_kernel_size = (32, 32)
-        features = np.zeros((len(combined_paths), FEATURE_DIM))
         model.eval()
         model.module.set_return_features(True)
-
-        #times = []
+        self._reset_feature_projector()
 
         average_pool_stride = average_pool_kernel_size[0] // 2
-        with torch.no_grad():
-            for batch_idx, sample in enumerate(tqdm(loader)):
-                #a = time.time()
-                _, features_batch = model(sample.cuda())
-                features_batch = F.avg_pool2d(features_batch, average_pool_kernel_size, average_pool_stride)
-                for feature_idx in range(features_batch.shape[0]):
-                    features[batch_idx * self.dataloader_batch_size + feature_idx, :] = features_batch[feature_idx, :, :, :].cpu().numpy().flatten()
-                #times.append(time.time() - a)
-        #print(np.mean(times), np.std(times))
+
+        def feature_batches(paths, budgeted):
+            loader = DataLoader(paths_dataset.PathsDataset(self.env, paths, self.crop_size),
+                                batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
+            with torch.no_grad():
+                for sample in (self._budgeted(tqdm(loader), 'features', len(loader)) if budgeted else tqdm(loader)):
+                    _, features_batch = self._forward(model, sample.cuda())
+                    features_batch = F.avg_pool2d(features_batch, average_pool_kernel_size, average_pool_stride)
+                    yield features_batch.view(features_batch.shape[0], -1).cpu().numpy()
+
+        def pooled_batches():
+            # the labeled images are always featurized in full, the time budget only ever drops candidates
+            if self.feature_store is None:
+                yield from feature_batches(already_selected_image_batch, False)
+                yield from feature_batches(candidate_image_batch, True)
+            else:
+                yield from self.feature_store.get_feature_batches(model, already_selected_image_batch)
+                yield from self.feature_store.get_feature_batches(model, candidate_image_batch, time_budget=self.time_budget)
+
+        features = np.concatenate([batch.astype(np.float16 if self.half_precision_features else np.float32)
+                                   for batch in self._project_feature_batches(pooled_batches())], axis=0)
 
         model.module.set_return_features(False)
+        # under a time budget features may only cover the labeled images and a random subsample of the candidates
+        combined_paths = combined_paths[:len(features)]
         selected_indices = self._select_batch(features, list(range(len(already_selected_image_batch))), selection_size)
         return [combined_paths[i] for i in selected_indices]
+
+    def _compute_static_embedding(self, model, paths):
+        loader = DataLoader(paths_dataset.PathsDataset(self.env, paths, self.crop_size),
+                            batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
+        self._reset_feature_projector()
+        model.eval()
+
+        def feature_batches():
+            with torch.no_grad():
+                for sample in tqdm(loader):
+                    if self.static_embedding == 'imagenet':
+                        # backbone output (1/16 resolution), pooled over the same image areas as the decoder features
+                        features_batch, _ = model.module.backbone(sample.cuda())
+                        features_batch = F.avg_pool2d(features_batch, (16, 16), 8)
+                    else:
+                        model.module.set_return_features(True)
+                        _, features_batch = self._forward(model, sample.cuda())
+                        model.module.set_return_features(False)
+                        kernel_size = 64 if model.module.model_name == 'deeplab' else 32
+                        features_batch = F.avg_pool2d(features_batch, kernel_size, kernel_size // 2)
+                    yield features_batch.view(features_batch.shape[0], -1).cpu().numpy()
+
+        return np.concatenate(list(self._project_feature_batches(feature_batches())), axis=0)
+
+    def _load_static_embedding(self, model, paths):
+        if self.static_features is not None:
+            return
+        if os.path.exists(self.static_embedding_path):
+            print(f'Loading static coreset embedding from {self.static_embedding_path}')
+            embedding = np.load(self.static_embedding_path)
+            embedding_paths, features = [bytes(p) for p in embedding['paths']], embedding['features']
+        else:
+            if self.static_embedding == 'imagenet':
+                if self.embedding_model is None or self.embedding_model.module.model_name != 'deeplab':
+                    raise NotImplementedError
+                model = self.embedding_model
+            print(f'Computing static coreset embedding ({self.static_embedding}) ..')
+            embedding_paths, features = list(paths), self._compute_static_embedding(model, paths)
+            np.savez(self.static_embedding_path, paths=np.array(embedding_paths), features=features)
+        self.static_path_to_index = {path: idx for idx, path in enumerate(embedding_paths)}
+        self.static_features = to_feature_tensor(features, get_distance_device(), self.half_precision_features)
+        self.static_feature_norms = squared_norms(self.static_features, self.distance_block_size)
+
+    def _get_static_k_center_greedy_selections(self, selection_size, model, candidate_image_batch, already_selected_image_batch):
+        combined_paths = already_selected_image_batch + candidate_image_batch
+        self._load_static_embedding(model, combined_paths)
+        assert all([path in self.static_path_to_index for path in combined_paths]), 'static embedding misses pool images'
+
+        # fold in only the images labeled since the last selection, O(N x new labels)
+        labeled_indices = [self.static_path_to_index[path] for path in already_selected_image_batch]
+        new_centers = [idx for idx in labeled_indices if idx not in self.static_centers]
+        if self.static_min_distances is None:
+            self.static_min_distances = torch.full((self.static_features.shape[0],), float('inf'), dtype=torch.float32, device=self.static_features.device)
+        if len(new_centers) > 0:
+            print(f'Folding {len(new_centers)} newly labeled images into coreset distances ..')
+            self.static_min_distances = self._updated_distances(new_centers, self.static_features, self.static_feature_norms, self.static_min_distances)
+            self.static_centers.update(new_centers)
+
+        # images outside the pool are never picked, picks of this round are folded in on a copy
+        min_distances = torch.full_like(self.static_min_distances, -1)
+        candidate_indices = torch.as_tensor([self.static_path_to_index[path] for path in candidate_image_batch], dtype=torch.long, device=min_distances.device)
+        min_distances[candidate_indices] = self.static_min_distances[candidate_indices]
+        new_batch = []
+        for _ in self._budgeted(range(selection_size), 'k-center greedy', selection_size):
+            ind = torch.argmax(min_distances).item()
+            assert ind not in self.static_centers
+            min_distances = self._updated_distances([ind], self.static_features, self.static_feature_norms, min_distances)
+            min_distances[ind] = -1
+            new_batch.append(ind)
+
+        print('Maximum distance from cluster centers is %0.5f' % min_distances.max().item())
+        index_to_path = {idx: path for path, idx in self.static_path_to_index.items()}
+        return [index_to_path[idx] for idx in new_batch]
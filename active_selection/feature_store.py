@@ -0,0 +1,80 @@
+from dataloaders.dataset import paths_dataset
+from torch.utils.data import DataLoader
+import torch.nn.functional as F
+import torch
+import numpy as np
+import os
+import shutil
+import tempfile
+from tqdm import tqdm
+from utils.amp import forward
+
+
+class FeatureStore:
+    """Pooled image embeddings of the current checkpoint, indexed by position in the pool.
+
+    Embeddings are computed the first time an image is requested and kept in a memmap until reset() is called for
+    the next checkpoint, so that every image is run through the network for features at most once per iteration.
+    """
+
+    def __init__(self, dataset_lmdb_env, crop_size, dataloader_batch_size, image_paths, cache_dir=None, amp=False):
+        self.env = dataset_lmdb_env
+        self.crop_size = crop_size
+        self.dataloader_batch_size = dataloader_batch_size
+        self.image_paths = list(image_paths)
+        self.path_to_index = {path: idx for idx, path in enumerate(self.image_paths)}
+        self.cache_dir = tempfile.mkdtemp(dir=cache_dir)
+        self.features = None
+        self.is_computed = np.zeros(len(image_paths), dtype=np.bool_)
+        self.amp = amp
+
+    def reset(self):
+        self.is_computed[:] = False
+
+    def close(self):
+        self.features = None
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _allocate(self, feature_dim):
+        self.features = np.memmap(os.path.join(self.cache_dir, 'features.dat'), dtype=np.float32, mode='w+',
+                                  shape=(len(self.is_computed), feature_dim))
+
+    def _compute(self, model, paths, time_budget=None):
+        loader = DataLoader(paths_dataset.PathsDataset(self.env, paths, self.crop_size),
+                            batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
+        if model.module.model_name == 'deeplab':
+            average_pool_kernel_size = (64, 64)
+        elif model.module.model_name == 'enet':
+            average_pool_kernel_size = (32, 32)
+        average_pool_stride = average_pool_kernel_size[0] // 2
+
+        model.eval()
+        model.module.set_return_features(True)
+        with torch.no_grad():
+            batches = tqdm(loader) if time_budget is None else time_budget.iterate(tqdm(loader), 'features', len(loader))
+            for batch_idx, sample in enumerate(batches):
+                _, features_batch = forward(model, sample.cuda(), self.amp)
+                features_batch = F.avg_pool2d(features_batch, average_pool_kernel_size, average_pool_stride)
+                features_batch = features_batch.view(features_batch.shape[0], -1).cpu().numpy()
+                if self.features is None:
+                    self._allocate(features_batch.shape[1])
+                batch_start = batch_idx * self.dataloader_batch_size
+                indices = [self.path_to_index[path] for path in paths[batch_start: batch_start + features_batch.shape[0]]]
+                self.features[indices] = features_batch
+                self.is_computed[indices] = True
+        model.module.set_return_features(False)
+
+    def get_feature_batches(self, model, paths, batch_size=None, time_budget=None):
+        """Generator over (batch_size x feature_dim) embeddings of the given paths, in order. If the time budget runs
+        out while computing, only the prefix of paths with features is returned."""
+        batch_size = self.dataloader_batch_size if batch_size is None else batch_size
+        indices = np.array([self.path_to_index[path] for path in paths], dtype=np.int64)
+        # missing images are computed in the requested order so that an interrupted pass still covers a prefix
+        missing = list(dict.fromkeys(indices[~self.is_computed[indices]].tolist()))
+        if len(missing) > 0:
+            print(f'Computing features for {len(missing)} images ..')
+            self._compute(model, [self.image_paths[idx] for idx in missing], time_budget)
+        not_computed = np.nonzero(~self.is_computed[indices])[0]
+        available = len(indices) if len(not_computed) == 0 else not_computed[0]
+        for start in range(0, available, batch_size):
+            yield np.asarray(self.features[indices[start: min(start + batch_size, available)]])
@@ -0,0 +1,129 @@
+import numpy as np
+from sklearn.metrics import pairwise_distances
+from active_selection.max_subset import ActiveSelectionMaxSubset
+
+
+class ActiveSelectionKMeans(ActiveSelectionMaxSubset):
+    """Representative selection with mini-batch k-means instead of facility location.
+
+    Pool features are clustered while they stream out of the model (k-means++ seeding on the first batches), then the
+    candidate closest to each centroid is selected. Memory depends on the number of clusters and candidates, not on
+    the pool size.
+    """
+
+    def __init__(self, dataset_lmdb_env, crop_size, dataloader_batch_size, seed=0, neighbors_per_centroid=8):
+        super(ActiveSelectionKMeans, self).__init__(dataset_lmdb_env, crop_size, dataloader_batch_size)
+        self.seed = seed
+        self.neighbors_per_centroid = neighbors_per_centroid
+
+    def _fit_kmeans(self, feature_batches, num_clusters):
+        from sklearn.cluster import MiniBatchKMeans
+
+        # k-means++ seeding needs a few samples per cluster, so the first batches are buffered
+        kmeans, buffered = None, []
+        for batch in feature_batches:
+            if kmeans is not None:
+                kmeans.partial_fit(batch)
+                continue
+            buffered.append(batch)
+            if sum([len(b) for b in buffered]) >= 3 * num_clusters:
+                kmeans = MiniBatchKMeans(n_clusters=num_clusters, init='k-means++', random_state=self.seed, n_init=1)
+                kmeans.partial_fit(np.concatenate(buffered, axis=0))
+                buffered = []
+        if kmeans is None and len(buffered) > 0:
+            buffered = np.concatenate(buffered, axis=0)
+            kmeans = MiniBatchKMeans(n_clusters=min(num_clusters, len(buffered)), init='k-means++', random_state=self.seed, n_init=1)
+            kmeans.partial_fit(buffered)
+        return kmeans
+
+    def _candidates_closest_to_centroids(self, centroids, candidate_features, num_selections=None, block_size=4096):
+        # the closest few candidates of every centroid, assigned greedily by distance so that no candidate is picked
+        # twice. Centroids whose close candidates are all taken get their closest free candidate afterwards, and when
+        # k-means fit fewer than num_selections centroids the free candidates closest to any centroid fill up the rest
+        candidate_features = np.asarray(candidate_features, dtype=np.float32)
+        k = min(self.neighbors_per_centroid, len(candidate_features))
+        best_distances = np.full((len(centroids), k), np.inf, dtype=np.float32)
+        best_indices = np.full((len(centroids), k), -1, dtype=np.int64)
+        for start in range(0, len(candidate_features), block_size):
+            distances = pairwise_distances(centroids, candidate_features[start: start + block_size]).astype(np.float32)
+            indices = np.broadcast_to(np.arange(start, start + distances.shape[1]), distances.shape)
+            all_distances = np.concatenate([best_distances, distances], axis=1)
+            all_indices = np.concatenate([best_indices, indices], axis=1)
+            top = np.argsort(all_distances, axis=1, kind='stable')[:, :k]
+            best_distances = np.take_along_axis(all_distances, top, axis=1)
+            best_indices = np.take_along_axis(all_indices, top, axis=1)
+
+        selected, is_assigned = [], np.zeros(len(centroids), dtype=np.bool_)
+        taken = set()
+        for flat_idx in np.argsort(best_distances, axis=None, kind='stable'):
+            centroid, rank = np.unravel_index(flat_idx, best_distances.shape)
+            candidate = best_indices[centroid, rank]
+            if is_assigned[centroid] or candidate < 0 or candidate in taken:
+                continue
+            is_assigned[centroid] = True
+            taken.add(candidate)
+            selected.append(int(candidate))
+
+        is_taken = np.zeros(len(candidate_features), dtype=np.bool_)
+        is_taken[selected] = True
+        for centroid in np.nonzero(~is_assigned)[0]:
+            if is_taken.all():
+                break
+            distances = np.concatenate([pairwise_distances(centroids[centroid: centroid + 1], candidate_features[start: start + block_size])[0]
+                                        for start in range(0, len(candidate_features), block_size)])
+            distances[is_taken] = np.inf
+            candidate = int(np.argmin(distances))
+            is_taken[candidate] = True
+            selected.append(candidate)
+
+        num_missing = min(num_selections, len(candidate_features)) - len(selected) if num_selections is not None else 0
+        if num_missing > 0:
+            distances = np.concatenate([pairwise_distances(centroids, candidate_features[start: start + block_size]).min(axis=0)
+                                        for start in range(0, len(candidate_features), block_size)])
+            distances[is_taken] = np.inf
+            selected.extend([int(i) for i in np.argsort(distances, kind='stable')[:num_missing]])
+        print(f'Assigned {len(selected)} candidates to {len(centroids)} centroids')
+        return selected
+
+    def get_representative_images(self, model, all_images, candidate_images):
+        self._reset_feature_projector()
+        all_images = [all_images[i] for i in self._pool_order(len(all_images))]
+        candidate_images = [candidate_images[i] for i in self._pool_order(len(candidate_images))]
+        print('Clustering image features for representativeness ..')
+        num_clusters = max(1, len(candidate_images) // 2)
+        kmeans = self._fit_kmeans(self._project_feature_batches(self._image_feature_batches(model, all_images)), num_clusters)
+        candidate_features = self._get_features_for_images(model, candidate_images)
+        candidate_images = candidate_images[:len(candidate_features)]
+        selected_candidate_indices = self._candidates_closest_to_centroids(kmeans.cluster_centers_, candidate_features, num_clusters)
+        return [candidate_images[i] for i in selected_candidate_indices]
+
+    def get_representative_regions(self, model, all_images, candidate_regions, region_size):
+        self._reset_feature_projector()
+        all_images = [all_images[i] for i in self._pool_order(len(all_images))]
+        num_candidates = sum([len(regions) for regions in candidate_regions.values()])
+        region_features, list_images, list_regions = [], [], []
+
+        def cell_batches():
+            # cells are clustered as they come, candidate region features are kept aside
+            for batch_cells, batch_region_features, batch_images, batch_regions in self._cell_and_region_feature_batches(model, all_images, region_size, candidate_regions):
+                if batch_region_features is not None:
+                    region_features.append(batch_region_features.cpu().numpy())
+                list_images.extend(batch_images)
+                list_regions.extend(batch_regions)
+                yield batch_cells.cpu().numpy()
+
+        print('Clustering cell features for representativeness ..')
+        num_clusters = max(1, num_candidates // 2)
+        kmeans = self._fit_kmeans(self._project_feature_batches(cell_batches()), num_clusters)
+        if len(region_features) == 0:
+            return {}, 0
+        region_features = np.concatenate(region_features, axis=0)
+        if self.feature_projector is not None:
+            region_features = self.feature_projector.transform(region_features)
+        selected_regions = {}
+        selected_candidate_indices = self._candidates_closest_to_centroids(kmeans.cluster_centers_, region_features, num_clusters)
+        for i in selected_candidate_indices:
+            if not list_images[i] in selected_regions:
+                selected_regions[list_images[i]] = []
+            selected_regions[list_images[i]].append(list_regions[i])
+        return selected_regions, len(selected_candidate_indices)
@@ -6,36 +6,164 @@ import numpy as np
 from sklearn.metrics import pairwise_distances
 from active_selection.base import ActiveSelectionBase
 import math
+import heapq
+import os
+import tempfile
 from tqdm import tqdm
 
 
 class ActiveSelectionMaxSubset(ActiveSelectionBase):
 
-    def __init__(self, dataset_lmdb_env, crop_size, dataloader_batch_size):
+    def __init__(self, dataset_lmdb_env, crop_size, dataloader_batch_size, greedy_mode='lazy', stochastic_epsilon=0.01, distance_block_size=2048,
+                 distance_dtype='float32', distance_memory_limit_gb=4.0, distance_cache_dir=None):
         super(ActiveSelectionMaxSubset, self).__init__(dataset_lmdb_env, crop_size, dataloader_batch_size)
+        assert greedy_mode in ['exact', 'lazy', 'stochastic'], 'unknown greedy mode'
+        assert distance_dtype in ['float32', 'float16'], 'unknown distance dtype'
+        self.greedy_mode = greedy_mode
+        self.stochastic_epsilon = stochastic_epsilon
+        self.stochastic_random = np.random.RandomState(0)
+        self.distance_block_size = distance_block_size
+        self.distance_dtype = np.dtype(distance_dtype)
+        self.distance_memory_limit = int(distance_memory_limit_gb * 2 ** 30)
+        self.distance_cache_dir = distance_cache_dir
 
-    def _max_representative_samples(self, image_features, candidate_image_features, selection_count):
-        all_distances = pairwise_distances(image_features, candidate_image_features, metric='euclidean')
+    def _rows_per_block(self, num_images):
+        # keep the float64 temporaries of a block around 64MB, whatever the number of images
+        return max(1, min(self.distance_block_size, (64 * 2 ** 20) // (8 * num_images)))
+
+    def _candidate_distances(self, image_features, candidate_image_features, cache_dir):
+        # one row per candidate, so that a candidate's distances to all images are contiguous. The matrix is kept in
+        # RAM below the memory limit and in a memmap above it, and is filled block by block in both cases
+        image_features = np.asarray(image_features)
+        candidate_image_features = np.asarray(candidate_image_features)
+        shape = (len(candidate_image_features), len(image_features))
+        if shape[0] * shape[1] * self.distance_dtype.itemsize <= self.distance_memory_limit:
+            candidate_distances = np.zeros(shape, dtype=self.distance_dtype)
+        else:
+            print(f'Distance matrix {shape} exceeds memory limit, using a memmap in {cache_dir}')
+            candidate_distances = np.memmap(os.path.join(cache_dir, 'distances.dat'), dtype=self.distance_dtype, mode='w+', shape=shape)
+        max_distance = 0
+        rows_per_block = self._rows_per_block(shape[1])
+        for start in range(0, shape[0], rows_per_block):
+            block = pairwise_distances(candidate_image_features[start: start + rows_per_block], image_features, metric='euclidean')
+            candidate_distances[start: start + rows_per_block] = block
+            max_distance = max(max_distance, float(candidate_distances[start: start + rows_per_block].max()))
+        return candidate_distances, max_distance
+
+    def _marginal_gains(self, candidate_distances, minimum_distances, candidate_indices):
+        # reduction of the facility location cost when adding each candidate, evaluated block by block
+        gains = np.zeros(len(candidate_indices), dtype=np.float64)
+        rows_per_block = self._rows_per_block(candidate_distances.shape[1])
+        for start in range(0, len(candidate_indices), rows_per_block):
+            block = candidate_distances[candidate_indices[start: start + rows_per_block]]
+            gains[start: start + rows_per_block] = np.maximum(minimum_distances[np.newaxis, :] - block, 0).sum(axis=1)
+        return gains
+
+    def _exact_greedy(self, candidate_distances, minimum_distances, selection_count):
+        all_indices = np.arange(candidate_distances.shape[0])
+        is_selected = np.zeros(candidate_distances.shape[0], dtype=np.bool_)
+        selected_sample_indices = []
+        for _ in self._budgeted(tqdm(range(selection_count)), 'facility location greedy', selection_count):
+            gains = self._marginal_gains(candidate_distances, minimum_distances, all_indices)
+            gains[is_selected] = float('-inf')
+            best_idx = int(np.argmax(gains))
+            is_selected[best_idx] = True
+            selected_sample_indices.append(best_idx)
+            minimum_distances = np.minimum(minimum_distances, candidate_distances[best_idx])
+        return selected_sample_indices
+
+    def _lazy_greedy(self, candidate_distances, minimum_distances, selection_count):
+        # gains only shrink as the selection grows (submodularity), so stale gains are upper bounds and only the
+        # top of the queue needs to be re-evaluated
+        gains = self._marginal_gains(candidate_distances, minimum_distances, np.arange(candidate_distances.shape[0]))
+        queue = [(-gain, idx) for idx, gain in enumerate(gains)]
+        heapq.heapify(queue)
+        selected_sample_indices = []
+        for _ in self._budgeted(tqdm(range(selection_count)), 'facility location greedy', selection_count):
+            while True:
+                _, idx = heapq.heappop(queue)
+                gain = np.maximum(minimum_distances - candidate_distances[idx], 0).sum()
+                if len(queue) == 0 or gain >= -queue[0][0]:
+                    break
+                heapq.heappush(queue, (-gain, idx))
+            selected_sample_indices.append(idx)
+            minimum_distances = np.minimum(minimum_distances, candidate_distances[idx])
+        return selected_sample_indices
+
+    def _stochastic_greedy(self, candidate_distances, minimum_distances, selection_count):
+        # each pick is the best of a random sample of (C / K) log(1 / epsilon) remaining candidates, drawn from one
+        # generator per selector so that every selection round samples differently
+        rng = self.stochastic_random
+        remaining = np.arange(candidate_distances.shape[0])
+        sample_size = int(math.ceil(candidate_distances.shape[0] / max(selection_count, 1) * math.log(1 / self.stochastic_epsilon)))
         selected_sample_indices = []
-        print('Finding max representative candidates..')
-        minimum_distances = np.ones((len(image_features))) * float('inf')
-        for _ in tqdm(range(selection_count)):
-            current_best_score = float("-inf")
-            current_best_idx = None
-            current_minimum_distances = None
-            for i in range(len(candidate_image_features)):
-                if i not in selected_sample_indices:
-                    selected_sample_indices.append(i)
-                    # tmp_distances = np.min(all_distances[:, selected_sample_indices], axis=1)  # np.minimum(current_minimum_distances, all_distances[:, i])
-                    tmp_distances = np.minimum(minimum_distances, all_distances[:, i])
-                    tmp_score = np.sum(tmp_distances) * -1
-                    if tmp_score > current_best_score:
-                        current_best_score = tmp_score
-                        current_minimum_distances = tmp_distances
-                        current_best_idx = i
-                    selected_sample_indices.pop()
-            selected_sample_indices.append(current_best_idx)
-            minimum_distances = current_minimum_distances
+        for _ in self._budgeted(tqdm(range(selection_count)), 'facility location greedy', selection_count):
+            sample = rng.choice(len(remaining), min(sample_size, len(remaining)), replace=False)
+            gains = self._marginal_gains(candidate_distances, minimum_distances, remaining[sample])
+            position = sample[int(np.argmax(gains))]
+            idx = int(remaining[position])
+            remaining = np.delete(remaining, position)
+            selected_sample_indices.append(idx)
+            minimum_distances = np.minimum(minimum_distances, candidate_distances[idx])
+        return selected_sample_indices
+
+    def _sparse_coverage(self, image_features, candidate_image_features):
+        # each image is only covered by its ann_neighbors closest candidates, found with an ANN index over the
+        # candidates. Returned in CSR layout with one row of (image index, distance) pairs per candidate
+        candidate_image_features = np.asarray(candidate_image_features, dtype=np.float32)
+        image_features = np.asarray(image_features, dtype=np.float32)
+        index = self._build_ann_index(candidate_image_features, image_features, k=self.ann_neighbors)
+        distances, candidate_indices = index.query(image_features, k=self.ann_neighbors)
+        image_indices = np.repeat(np.arange(len(image_features)), distances.shape[1])
+        candidate_indices, distances = candidate_indices.ravel(), distances.ravel()
+        valid = candidate_indices >= 0
+        order = np.argsort(candidate_indices[valid], kind='stable')
+        indices = image_indices[valid][order]
+        data = distances[valid][order].astype(np.float64)
+        indptr = np.searchsorted(candidate_indices[valid][order], np.arange(len(candidate_image_features) + 1))
+        return indptr, indices, data
+
+    def _sparse_lazy_greedy(self, indptr, indices, data, minimum_distances, selection_count):
+        # same lazy greedy as the dense case, images outside a candidate's row gain nothing from it
+        def gain(idx):
+            row = slice(indptr[idx], indptr[idx + 1])
+            return np.maximum(minimum_distances[indices[row]] - data[row], 0).sum()
+
+        queue = [(-gain(idx), idx) for idx in range(len(indptr) - 1)]
+        heapq.heapify(queue)
+        selected_sample_indices = []
+        for _ in self._budgeted(tqdm(range(selection_count)), 'facility location greedy', selection_count):
+            while True:
+                _, idx = heapq.heappop(queue)
+                current_gain = gain(idx)
+                if len(queue) == 0 or current_gain >= -queue[0][0]:
+                    break
+                heapq.heappush(queue, (-current_gain, idx))
+            selected_sample_indices.append(idx)
+            row = slice(indptr[idx], indptr[idx + 1])
+            minimum_distances[indices[row]] = np.minimum(minimum_distances[indices[row]], data[row])
+        return selected_sample_indices
+
+    def _max_representative_samples(self, image_features, candidate_image_features, selection_count):
+        if self.ann_backend is not None:
+            indptr, indices, data = self._sparse_coverage(image_features, candidate_image_features)
+            print('Finding max representative candidates..')
+            minimum_distances = np.full(len(image_features), data.max() if len(data) > 0 else 0.0)
+            return self._sparse_lazy_greedy(indptr, indices, data, minimum_distances, min(selection_count, len(indptr) - 1))
+        with tempfile.TemporaryDirectory(dir=self.distance_cache_dir) as cache_dir:
+            candidate_distances, max_distance = self._candidate_distances(image_features, candidate_image_features, cache_dir)
+            print('Finding max representative candidates..')
+            # facility location cost is the sum over images of the distance to the closest selected candidate; starting
+            # from the largest distance instead of inf makes the first pick the candidate with the smallest sum of distances
+            minimum_distances = np.full(candidate_distances.shape[1], max_distance)
+            selection_count = min(selection_count, candidate_distances.shape[0])
+            if self.greedy_mode == 'exact':
+                selected_sample_indices = self._exact_greedy(candidate_distances, minimum_distances, selection_count)
+            elif self.greedy_mode == 'lazy':
+                selected_sample_indices = self._lazy_greedy(candidate_distances, minimum_distances, selection_count)
+            else:
+                selected_sample_indices = self._stochastic_greedy(candidate_distances, minimum_distances, selection_count)
+            del candidate_distances
         return selected_sample_indices
 
     def _convert_regions_to_list(self, regions):
@@ -46,32 +174,81 @@ class ActiveSelectionMaxSubset(ActiveSelectionBase):
                 list_regions.append(r)
         return list_images, list_regions
 
-    def _get_features_for_image_regions(self, model, images, region_size):
+    def _collect_projected_features(self, feature_batches):
         features = []
+        for batch in self._project_feature_batches(feature_batches):
+            features.extend(batch)
+        return features
+
+    def _pool_cells(self, features_batch, image_shape, region_size):
+        # all region_size cells of the batch in one pooling op, partial cells at the border are dropped as before
+        h = max(1, math.floor(region_size * features_batch.shape[2] / image_shape[0]))
+        w = max(1, math.floor(region_size * features_batch.shape[3] / image_shape[1]))
+        cells = F.avg_pool2d(features_batch, (h, w), (h, w))
+        return cells.permute(0, 2, 3, 1).reshape(-1, features_batch.shape[1])
+
+    def _pool_regions(self, features_batch, image_shape, batch_regions):
+        # mean over every (r, c, h, w) box from box sums of an integral image, all boxes gathered at once
+        integral = F.pad(features_batch.double().cumsum(2).cumsum(3), (1, 0, 1, 0))
+        resize_ratio_r = features_batch.shape[2] / image_shape[0]
+        resize_ratio_c = features_batch.shape[3] / image_shape[1]
+        boxes = []
+        for feature_idx, region in batch_regions:
+            r = min(math.floor(region[0] * resize_ratio_r), features_batch.shape[2] - 1)
+            c = min(math.floor(region[1] * resize_ratio_c), features_batch.shape[3] - 1)
+            h = min(max(1, math.floor(region[2] * resize_ratio_r)), features_batch.shape[2] - r)
+            w = min(max(1, math.floor(region[3] * resize_ratio_c)), features_batch.shape[3] - c)
+            boxes.append([feature_idx, r, c, r + h, c + w])
+        boxes = torch.tensor(boxes, dtype=torch.long, device=features_batch.device)
+        idx, r0, c0, r1, c1 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3], boxes[:, 4]
+        sums = integral[idx, :, r1, c1] - integral[idx, :, r0, c1] - integral[idx, :, r1, c0] + integral[idx, :, r0, c0]
+        return (sums / ((r1 - r0) * (c1 - c0)).unsqueeze(1).double()).float()
+
+    def _cell_and_region_feature_batches(self, model, images, region_size, regions):
+        """Generator over (cell features, region features or None, region images, regions) per batch of images, from
+        one forward per image. Features stay on the device."""
+        image_set = set(images)
+        assert all([path in image_set for path in regions.keys()]), 'regions of images outside the pool'
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         model.eval()
         model.module.set_return_features(True)
         with torch.no_grad():
-            for batch_idx, image_batch in enumerate(tqdm(loader)):
+            for batch_idx, image_batch in enumerate(self._budgeted(tqdm(loader), 'region features', len(loader))):
                 image_batch = image_batch.cuda()
-                _, features_batch = model(image_batch)
-                h = math.floor(region_size * features_batch.shape[2] / self.crop_size)
-                w = math.floor(region_size * features_batch.shape[3] / self.crop_size)
-                num_rows = math.floor(features_batch.shape[2] / h)
-                num_cols = math.floor(features_batch.shape[3] / w)
-                for feature_idx in range(features_batch.shape[0]):
-                    for row_idx in range(num_rows):
-                        for col_idx in range(num_cols):
-                            row_start = row_idx * h
-                            col_start = col_idx * w
-                            features.append(F.avg_pool2d(features_batch[feature_idx, :, row_start: row_start + h,
-                                                                        col_start: col_start + w], (features_batch.shape[2], features_batch.shape[3])).squeeze().cpu().numpy())
+                _, features_batch = self._forward(model, image_batch)
+                image_shape = (image_batch.shape[2], image_batch.shape[3])
+                batch_start = batch_idx * self.dataloader_batch_size
+                batch_regions, list_images, list_regions = [], [], []
+                for feature_idx, path in enumerate(images[batch_start: batch_start + features_batch.shape[0]]):
+                    for region in regions.get(path, []):
+                        batch_regions.append((feature_idx, region))
+                        list_images.append(path)
+                        list_regions.append(region)
+                region_features = self._pool_regions(features_batch, image_shape, batch_regions) if len(batch_regions) > 0 else None
+                yield self._pool_cells(features_batch, image_shape, region_size), region_features, list_images, list_regions
         model.module.set_return_features(False)
-        return features
 
-    def _get_features_for_images(self, model, images):
-        features = []
+    def _get_cell_and_region_features(self, model, images, region_size, regions):
+        """Features of all region_size cells of the images and of the given regions (dict image -> list of regions),
+        with one host copy per kind. Regions are returned grouped per image, in the order of the images."""
+        cell_features, region_features, list_images, list_regions = [], [], [], []
+        for batch_cells, batch_region_features, batch_images, batch_regions in self._cell_and_region_feature_batches(model, images, region_size, regions):
+            cell_features.append(batch_cells)
+            if batch_region_features is not None:
+                region_features.append(batch_region_features)
+            list_images.extend(batch_images)
+            list_regions.extend(batch_regions)
+        cell_features = torch.cat(cell_features, dim=0).cpu().numpy()
+        region_features = torch.cat(region_features, dim=0).cpu().numpy() if len(region_features) > 0 else np.zeros((0, cell_features.shape[1]), dtype=np.float32)
+        return cell_features, region_features, list_images, list_regions
+
+    def _image_feature_batches(self, model, images):
+        """Generator over pooled (unprojected) image features, batch by batch"""
+        # with a feature store, images shared between the pool and the candidates are only forwarded once
+        if self.feature_store is not None:
+            yield from self.feature_store.get_feature_batches(model, images, time_budget=self.time_budget)
+            return
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         model.eval()
@@ -79,45 +256,32 @@ class ActiveSelectionMaxSubset(ActiveSelectionBase):
         average_pool_kernel_size = (64, 64)
         average_pool_stride = average_pool_kernel_size[0] // 2
         with torch.no_grad():
-            for batch_idx, image_batch in enumerate(tqdm(loader)):
+            for batch_idx, image_batch in enumerate(self._budgeted(tqdm(loader), 'features', len(loader))):
                 image_batch = image_batch.cuda()
-                _, features_batch = model(image_batch)
-                for feature_idx in range(features_batch.shape[0]):
-                    features.append(F.avg_pool2d(features_batch[feature_idx, :, :, :], average_pool_kernel_size,
-                                                 average_pool_stride).squeeze().cpu().numpy().flatten())
+                _, features_batch = self._forward(model, image_batch)
+                features_batch = F.avg_pool2d(features_batch, average_pool_kernel_size, average_pool_stride)
+                yield features_batch.view(features_batch.shape[0], -1).cpu().numpy()
         model.module.set_return_features(False)
-        return features
 
-    def _get_features_for_regions(self, model, list_images, list_regions):
-        features = []
-        loader = DataLoader(paths_dataset.PathsDataset(self.env, list_images, self.crop_size),
-                            batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
-        model.eval()
-        model.module.set_return_features(True)
-        with torch.no_grad():
-            for batch_idx, image_batch in enumerate(tqdm(loader)):
-                image_batch = image_batch.cuda()
-                _, features_batch = model(image_batch)
-                resize_ratio_r = features_batch.shape[2] / self.crop_size
-                resize_ratio_c = features_batch.shape[3] / self.crop_size
-                for feature_idx in range(features_batch.shape[0]):
-                    region = list_regions[batch_idx * self.dataloader_batch_size + feature_idx]
-                    r = math.floor(region[0] * resize_ratio_r)
-                    c = math.floor(region[1] * resize_ratio_c)
-                    h = math.floor(region[2] * resize_ratio_r)
-                    w = math.floor(region[3] * resize_ratio_c)
-                    features.append(F.avg_pool2d(features_batch[feature_idx, :, r: r + h, c: c + w],
-                                                 (features_batch.shape[2], features_batch.shape[3])).squeeze().cpu().numpy())
+    def _get_features_for_images(self, model, images):
+        return self._collect_projected_features(self._image_feature_batches(model, images))
 
-        model.module.set_return_features(False)
-        return features
+    def _split_rows(self, features, rows_per_batch=1024):
+        return [features[start: start + rows_per_batch] for start in range(0, len(features), rows_per_batch)]
 
     def get_representative_regions(self, model, all_images, candidate_regions, region_size):
-        candidate_list_images, candidate_list_regions = self._convert_regions_to_list(candidate_regions)
-        print('Getting features for images for representativeness ..')
-        all_image_features = self._get_features_for_image_regions(model, all_images, region_size)
-        print('Getting features for candidates for representativeness ..')
-        region_features = self._get_features_for_regions(model, candidate_list_images, candidate_list_regions)
+        print('Getting features for images and candidates for representativeness ..')
+        all_images = [all_images[i] for i in self._pool_order(len(all_images))]
+        all_image_features, region_features, list_images, list_regions = self._get_cell_and_region_features(model, all_images, region_size, candidate_regions)
+        # candidates in the same order as _convert_regions_to_list, the stable sort keeps the order within an image
+        order = sorted(range(len(list_images)), key=lambda i: list_images[i])
+        candidate_list_images = [list_images[i] for i in order]
+        candidate_list_regions = [list_regions[i] for i in order]
+        region_features = region_features[order]
+        # image cells and candidates are projected into the same space, fitted on the image cells
+        self._reset_feature_projector()
+        all_image_features = self._collect_projected_features(self._split_rows(all_image_features))
+        region_features = self._collect_projected_features(self._split_rows(region_features))
         selected_candidate_indices = self._max_representative_samples(all_image_features, region_features, len(region_features) // 2)
         # self._visualize_selections(all_image_features, region_features, [region_features[i] for i in selected_candidate_indices])
         selected_regions = {}
@@ -128,9 +292,14 @@ class ActiveSelectionMaxSubset(ActiveSelectionBase):
         return selected_regions, len(selected_candidate_indices)
 
     def get_representative_images(self, model, all_images, candidate_images):
+        self._reset_feature_projector()
+        all_images = [all_images[i] for i in self._pool_order(len(all_images))]
+        candidate_images = [candidate_images[i] for i in self._pool_order(len(candidate_images))]
         print('Getting features for images for representativeness ..')
         all_image_features = self._get_features_for_images(model, all_images)
+        # under a time budget only a prefix of the (shuffled) candidates may have features
         candidate_features = self._get_features_for_images(model, candidate_images)
+        candidate_images = candidate_images[:len(candidate_features)]
         selected_candidate_indices = self._max_representative_samples(all_image_features, candidate_features, len(candidate_features) // 2)
         # self._visualize_selections(all_image_features, candidate_features, [candidate_features[i] for i in selected_candidate_indices])
         return [candidate_images[i] for i in selected_candidate_indices]
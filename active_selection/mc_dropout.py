@@ -6,6 +6,7 @@ import torch
 from dataloaders.utils import map_segmentation_to_colors
 import numpy as np
 from active_selection.base import ActiveSelectionBase
+from utils.superpixels import load_superpixels
 from tqdm import tqdm
 import constants
 import random
@@ -37,7 +38,7 @@ class ActiveSelectionMCDropout(ActiveSelectionBase):
         outputs = torch.cuda.FloatTensor(image_batch.shape[0], constants.MC_STEPS, image_batch.shape[2], image_batch.shape[3])
         with torch.no_grad():
             for step in range(constants.MC_STEPS):
-                outputs[:, step, :, :] = torch.argmax(model(image_batch), dim=1)
+                outputs[:, step, :, :] = torch.argmax(self._forward(model, image_batch), dim=1)
 
         entropy_maps = []
         for i in range(image_batch.shape[0]):
@@ -80,11 +81,13 @@ class ActiveSelectionMCDropout(ActiveSelectionBase):
         return entropy_maps
 
     @staticmethod
-    def square_nms(score_maps, region_size, max_selection_count):
+    def square_nms(score_maps, region_size, max_selection_count, time_budget=None):
         ones_tensor = torch.FloatTensor(score_maps.shape[1], score_maps.shape[2]).fill_(0)
         selected_regions = [[] for x in range(score_maps.shape[0])]
 
         tbar = tqdm(list(range(math.ceil(max_selection_count))), desc='NMS')
+        if time_budget is not None:
+            tbar = time_budget.iterate(tbar, 'nms', math.ceil(max_selection_count))
 
         selection_count = 0
         for iter_idx in tbar:
@@ -126,6 +129,8 @@ class ActiveSelectionMCDropout(ActiveSelectionBase):
             if type(m) == torch.nn.Dropout2d:
                 m.train()
         model.apply(turn_on_dropout)
+        order = self._pool_order(len(images))
+        images, existing_regions = [images[i] for i in order], [existing_regions[i] for i in order]
         base_size = 512 if self.crop_size == -1 else self.crop_size
         score_maps = torch.cuda.FloatTensor(len(images), base_size - region_size + 1, base_size - region_size + 1)
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
@@ -137,7 +142,7 @@ class ActiveSelectionMCDropout(ActiveSelectionBase):
         # commented lines are for visualization and verification
         #entropy_maps = []
         #base_images = []
-        for sample in tqdm(loader):
+        for sample in self._budgeted(tqdm(loader), 'region scoring', len(loader)):
             image_batch = sample['image'].cuda()
             label_batch = sample['label'].cuda()
             #a = time.time()
@@ -149,13 +154,14 @@ class ActiveSelectionMCDropout(ActiveSelectionBase):
                     0).unsqueeze(0), weights.unsqueeze(0).unsqueeze(0)).squeeze().squeeze()
                 map_ctr += 1
             #times.append(time.time()-a)
+        score_maps = score_maps[:map_ctr]
         min_val = score_maps.min()
         max_val = score_maps.max()
         minmax_norm = lambda x: x.add_(-min_val).mul_(1.0 / (max_val - min_val))
         minmax_norm(score_maps)
         #print(np.mean(times), np.std(times))
         num_requested_indices = (selection_size * base_size * base_size) / (region_size * region_size)
-        regions, num_selected_indices = ActiveSelectionMCDropout.square_nms(score_maps.cpu(), region_size, num_requested_indices)
+        regions, num_selected_indices = ActiveSelectionMCDropout.square_nms(score_maps.cpu(), region_size, num_requested_indices, self.time_budget)
         # print(f'Requested/Selected indices {num_requested_indices}/{num_selected_indices}')
 
         # for i in range(len(regions)):
@@ -170,6 +176,63 @@ class ActiveSelectionMCDropout(ActiveSelectionBase):
 
         return new_regions, num_selected_indices
 
+    def create_superpixel_maps(self, model, images, existing_regions, existing_superpixels, superpixel_env, selection_size):
+
+        def turn_on_dropout(m):
+            if type(m) == torch.nn.Dropout2d:
+                m.train()
+        model.apply(turn_on_dropout)
+        order = self._pool_order(len(images))
+        images = [images[i] for i in order]
+        existing_regions, existing_superpixels = [existing_regions[i] for i in order], [existing_superpixels[i] for i in order]
+        base_size = 512 if self.crop_size == -1 else self.crop_size
+        loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
+                            batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
+
+        segment_scores, segment_areas, segment_images, segment_ids = [], [], [], []
+        map_ctr = 0
+        for sample in self._budgeted(tqdm(loader), 'superpixel scoring', len(loader)):
+            image_batch = sample['image'].cuda()
+            label_batch = sample['label'].cuda()
+            for entropy_map in self._get_vote_entropy_for_batch(model, image_batch, label_batch):
+                ActiveSelectionMCDropout.suppress_labeled_entropy(entropy_map, existing_regions[map_ctr])
+                superpixels = torch.from_numpy(load_superpixels(superpixel_env, images[map_ctr]).astype(np.int64)).cuda().view(-1)
+                num_segments = superpixels.max().item() + 1
+                areas = torch.bincount(superpixels, minlength=num_segments).float()
+                # mean entropy per segment from a single scatter-add over the pixels
+                scores = torch.cuda.FloatTensor(num_segments).fill_(0).scatter_add_(0, superpixels, entropy_map.view(-1)) / areas.clamp(min=1)
+                if existing_superpixels[map_ctr]:
+                    scores[torch.cuda.LongTensor(existing_superpixels[map_ctr])] = 0
+                segment_scores.append(scores)
+                segment_areas.append(areas)
+                segment_images.append(torch.cuda.LongTensor(num_segments).fill_(map_ctr))
+                segment_ids.append(torch.arange(num_segments).cuda())
+                map_ctr += 1
+
+        segment_scores = torch.cat(segment_scores)
+        segment_areas = torch.cat(segment_areas)
+        segment_images = torch.cat(segment_images)
+        segment_ids = torch.cat(segment_ids)
+
+        # top segments until the pixel budget is used up, no suppression needed since segments do not overlap
+        order = torch.argsort(segment_scores, descending=True)
+        num_requested_pixels = selection_size * base_size * base_size
+        within_budget = (torch.cumsum(segment_areas[order], dim=0) <= num_requested_pixels) & (segment_scores[order] > 0)
+        selected = order[within_budget].cpu().numpy()
+        num_selected_pixels = int(segment_areas[order][within_budget].sum().item())
+
+        new_superpixels = {}
+        selected_images = segment_images.cpu().numpy()[selected]
+        selected_ids = segment_ids.cpu().numpy()[selected]
+        for i, segment_id in zip(selected_images, selected_ids):
+            if images[i] not in new_superpixels:
+                new_superpixels[images[i]] = []
+            new_superpixels[images[i]].append(int(segment_id))
+
+        model.eval()
+
+        return new_superpixels, num_selected_pixels
+
     def get_vote_entropy_for_images(self, model, images, selection_count):
 
         def turn_on_dropout(m):
@@ -177,12 +240,13 @@ class ActiveSelectionMCDropout(ActiveSelectionBase):
                 m.train()
         model.apply(turn_on_dropout)
 
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
 
         entropies = []
         #times = []
-        for sample in tqdm(loader):
+        for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
             image_batch = sample['image'].cuda()
             label_batch = sample['label'].cuda()
             #a = time.time()
@@ -24,7 +24,7 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
         with torch.no_grad():
             for step in range(constants.MC_STEPS):
                 noise = np.random.normal(loc=0.0, scale=0.125, size=image_batch.shape).astype(np.float32)
-                outputs[:, step, :, :] = torch.argmax(model(image_batch + torch.from_numpy(noise).cuda()), dim=1)
+                outputs[:, step, :, :] = torch.argmax(self._forward(model, image_batch + torch.from_numpy(noise).cuda()), dim=1)
 
         entropy_maps = []
 
@@ -45,12 +45,13 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
 
     def get_vote_entropy_for_images_with_input_noise(self, model, images, selection_count):
 
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         model.eval()
 
         entropies = []
-        for sample in tqdm(loader):
+        for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
             image_batch = sample['image'].cuda()
             label_batch = sample['label'].cuda()
             entropies.extend([torch.sum(x).cpu().item() / (image_batch.shape[2] * image_batch.shape[3])
@@ -64,7 +65,7 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
         outputs = torch.cuda.FloatTensor(image_batch.shape[0], constants.MC_STEPS, image_batch.shape[2], image_batch.shape[3])
         with torch.no_grad():
             for step in range(constants.MC_STEPS):
-                outputs[:, step, :, :] = torch.argmax(model(image_batch), dim=1)
+                outputs[:, step, :, :] = torch.argmax(self._forward(model, image_batch), dim=1)
 
         entropy_maps = []
 
@@ -93,7 +94,7 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
         outputs = torch.cuda.FloatTensor(image_batch.shape[0], constants.MC_STEPS, image_batch.shape[2], image_batch.shape[3])
         with torch.no_grad():
             for step in range(constants.MC_STEPS):
-                outputs[:, step, :, :] = torch.argmax(model(image_batch), dim=1)
+                outputs[:, step, :, :] = torch.argmax(self._forward(model, image_batch), dim=1)
 
         entropy_maps = []
 
@@ -115,11 +116,12 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
 
     def get_vote_entropy_for_images_with_feature_noise(self, model, images, selection_count):
 
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         model.eval()
         entropies = []
-        for sample in tqdm(loader):
+        for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
             image_batch = sample['image'].cuda()
             label_batch = sample['label'].cuda()
             entropies.extend([torch.sum(x).cpu().item() / (image_batch.shape[2] * image_batch.shape[3])
@@ -130,12 +132,13 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
 
     def get_vote_entropy_for_batch_with_noise_and_vote_entropy(self, model, images, selection_count):
 
+        images = [images[i] for i in self._pool_order(len(images))]
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
                             batch_size=self.dataloader_batch_size, shuffle=False, num_workers=0)
         model.eval()
 
         entropies = []
-        for sample in tqdm(loader):
+        for sample in self._budgeted(tqdm(loader), 'image scoring', len(loader)):
             image_batch = sample['image'].cuda()
             label_batch = sample['label'].cuda()
             noise_entropies = self._get_vote_entropy_for_batch_with_feature_noise(model, image_batch, label_batch)
@@ -149,6 +152,8 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
         return selected_samples
 
     def create_region_maps(self, model, images, existing_regions, region_size, selection_size):
+        order = self._pool_order(len(images))
+        images, existing_regions = [images[i] for i in order], [existing_regions[i] for i in order]
         base_size = 512 if self.crop_size == -1 else self.crop_size
         score_maps = torch.cuda.FloatTensor(len(images), base_size - region_size + 1, base_size - region_size + 1)
         loader = DataLoader(paths_dataset.PathsDataset(self.env, images, self.crop_size, include_labels=True),
@@ -159,7 +164,7 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
         # commented lines are for visualization and verification
         # entropy_maps = []
         # base_images = []
-        for sample in tqdm(loader):
+        for sample in self._budgeted(tqdm(loader), 'region scoring', len(loader)):
             image_batch = sample['image'].cuda()
             label_batch = sample['label'].cuda()
             noise_entropies = self._get_vote_entropy_for_batch_with_feature_noise(model, image_batch, label_batch)
@@ -173,13 +178,14 @@ class ActiveSelectionMCNoise(ActiveSelectionBase):
                     0).unsqueeze(0), weights.unsqueeze(0).unsqueeze(0)).squeeze().squeeze()
                 map_ctr += 1
 
+        score_maps = score_maps[:map_ctr]
         min_val = score_maps.min()
         max_val = score_maps.max()
         minmax_norm = lambda x: x.add_(-min_val).mul_(1.0 / (max_val - min_val))
         minmax_norm(score_maps)
 
         num_requested_indices = (selection_size * base_size * base_size) / (region_size * region_size)
-        regions, num_selected_indices = ActiveSelectionMCDropout.square_nms(score_maps.cpu(), region_size, num_requested_indices)
+        regions, num_selected_indices = ActiveSelectionMCDropout.square_nms(score_maps.cpu(), region_size, num_requested_indices, self.time_budget)
         # print(f'Requested/Selected indices {num_requested_indices}/{num_selected_indices}')
 
         # for i in range(len(regions)):
@@ -0,0 +1,79 @@
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+
+
+class FeatureProjector:
+    """Projects pooled features to a lower dimension while they stream out of the model.
+
+    The projection (a gaussian random projection or an incremental PCA) is fitted on the first fit_sample_size
+    features of a selection pass and then kept until reset(), so that all features of one selection live in the
+    same space. The distortion of pairwise distances on the fit sample is reported after fitting.
+    """
+
+    def __init__(self, mode, dim, fit_sample_size=1024, seed=0):
+        assert mode in ['random', 'pca'], 'unknown projection'
+        self.mode = mode
+        self.dim = dim
+        self.fit_sample_size = fit_sample_size
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        self.projection = None
+        self.pca = None
+        self.distortion = None
+
+    def is_fitted(self):
+        return self.projection is not None or self.pca is not None
+
+    def fit(self, sample):
+        sample = np.asarray(sample, dtype=np.float32)
+        if self.mode == 'random':
+            rng = np.random.RandomState(self.seed)
+            self.projection = (rng.normal(size=(sample.shape[1], self.dim)) / np.sqrt(self.dim)).astype(np.float32)
+        else:
+            self.pca = IncrementalPCA(n_components=min(self.dim, sample.shape[0], sample.shape[1]))
+            self.pca.fit(sample)
+        self.distortion = self._measure_distortion(sample)
+        print(f'Projected features from {sample.shape[1]} to {self.transform(sample[:1]).shape[1]} dimensions, '
+              f'mean/max relative distance error = {self.distortion[0]:.4f}/{self.distortion[1]:.4f}')
+
+    def transform(self, features):
+        features = np.asarray(features, dtype=np.float32)
+        if features.shape[1] <= self.dim:
+            return features
+        if self.mode == 'random':
+            return features.dot(self.projection)
+        return self.pca.transform(features).astype(np.float32)
+
+    def project(self, feature_batches):
+        """Generator over projected batches, in order. Batches are buffered only until the fit sample is complete."""
+        buffered = []
+        for batch in feature_batches:
+            if self.is_fitted():
+                yield self.transform(batch)
+                continue
+            buffered.append(batch)
+            if sum([len(b) for b in buffered]) >= self.fit_sample_size:
+                self.fit(np.concatenate(buffered, axis=0))
+                for b in buffered:
+                    yield self.transform(b)
+                buffered = []
+        if buffered:
+            self.fit(np.concatenate(buffered, axis=0))
+            for b in buffered:
+                yield self.transform(b)
+
+    def _measure_distortion(self, sample, num_pairs=2000):
+        if sample.shape[1] <= self.dim or len(sample) < 2:
+            return 0.0, 0.0
+        rng = np.random.RandomState(self.seed)
+        i = rng.randint(0, len(sample), num_pairs)
+        j = rng.randint(0, len(sample), num_pairs)
+        valid = i != j
+        i, j = i[valid], j[valid]
+        original = np.linalg.norm(sample[i] - sample[j], axis=1)
+        projected_sample = self.transform(sample)
+        projected = np.linalg.norm(projected_sample[i] - projected_sample[j], axis=1)
+        relative_error = np.abs(projected - original) / np.maximum(original, 1e-12)
+        return float(relative_error.mean()), float(relative_error.max())
@@ -56,12 +56,8 @@ def get_validation_mIoUs():
             unet_target = deeplab_output.argmax(1).squeeze() == deeplab_target.long()
             unet_target[deeplab_target == 255] = 255
 
-            pred = deeplab_output.data.cpu().numpy()
-            deeplab_target = deeplab_target.cpu().numpy()
-            pred = np.argmax(pred, axis=1)
-
-            deeplab_evaluator.add_batch(deeplab_target, pred)
-            unet_evaluator.add_batch(unet_target.cpu().numpy(), np.argmax(unet_output.cpu().numpy(), axis=1))
+            deeplab_evaluator.add_batch(deeplab_target, deeplab_output.argmax(1))
+            unet_evaluator.add_batch(unet_target, unet_output.argmax(1))
 
         # Fast test during the training
         Acc = deeplab_evaluator.Pixel_Accuracy()
@@ -127,10 +123,7 @@ def test_entropy_map_for_images():
             loss = criterion(output, target)
             test_loss += loss.item()
             tbar.set_description('Test loss: %.3f' % (test_loss / (i + 1)))
-            pred = output.data.cpu().numpy()
-            target = target.cpu().numpy()
-            pred = np.argmax(pred, axis=1)
-            evaluator.add_batch(target, pred)
+            evaluator.add_batch(target, output.argmax(1))
 
         # Fast test during the training
         Acc = evaluator.Pixel_Accuracy()
@@ -562,6 +555,37 @@ def test_kcenter():
     print(selected_indices)
 
 
+def test_kcenter_blockwise():
+    from sklearn.metrics import pairwise_distances
+    features = np.random.normal(loc=0.0, scale=3.0, size=(3000, 64))
+    min_distances = np.min(pairwise_distances(features, features[:50]), axis=1)
+    expected_indices = []
+    for _ in range(20):
+        expected_indices.append(int(np.argmax(min_distances)))
+        min_distances = np.minimum(min_distances, pairwise_distances(features, features[expected_indices[-1:]])[:, 0])
+    active_selection = ActiveSelectionCoreSet(None, None, None, distance_block_size=512)
+    selected_indices = active_selection._select_batch(features, list(range(50)), 20)
+    print(selected_indices == expected_indices)
+
+
+def test_kcenter_truncated_pool():
+    # a feature pass cut short by the time budget leaves fewer candidates than picks
+    active_selection = ActiveSelectionCoreSet(None, None, None)
+    selected_indices = active_selection._select_batch(np.random.normal(size=(60, 8)), list(range(50)), 20)
+    assert sorted(selected_indices) == list(range(50, 60))
+    assert active_selection._select_batch(np.random.normal(size=(50, 8)), list(range(50)), 20) == []
+
+
+def test_feature_projection():
+    from active_selection.projection import FeatureProjector
+    # low rank features, pca should keep distances almost exactly while random projection approximates them
+    features = np.random.normal(size=(2000, 64)).dot(np.random.normal(size=(64, 2736))).astype(np.float32)
+    for mode in ['random', 'pca']:
+        projector = FeatureProjector(mode, 128)
+        projected = np.concatenate(list(projector.project(np.array_split(features, 20))), axis=0)
+        print(mode, projected.shape, projector.distortion)
+
+
 def test_ceal():
     from dataloaders.dataset import active_cityscapes
     from sklearn.manifold import TSNE
@@ -655,6 +679,78 @@ def test_max_set_cover():
             plt.show()
 
 
+def test_max_set_cover_greedy_modes():
+    image_features = np.random.normal(size=(2000, 32))
+    candidate_features = np.random.normal(size=(500, 32))
+    selections = {}
+    for mode in ['exact', 'lazy', 'stochastic']:
+        selections[mode] = ActiveSelectionMaxSubset(None, None, None, greedy_mode=mode)._max_representative_samples(image_features, candidate_features, 100)
+    print(selections['exact'] == selections['lazy'], len(set(selections['exact']) & set(selections['stochastic'])))
+    # consecutive rounds of one selector sample different candidates
+    max_subset_selector = ActiveSelectionMaxSubset(None, None, None, greedy_mode='stochastic')
+    print(max_subset_selector._max_representative_samples(image_features, candidate_features, 100) != max_subset_selector._max_representative_samples(image_features, candidate_features, 100))
+
+
+def test_max_set_cover_memmap():
+    image_features = np.random.normal(size=(5000, 32))
+    candidate_features = np.random.normal(size=(500, 32))
+    in_memory = ActiveSelectionMaxSubset(None, None, None)._max_representative_samples(image_features, candidate_features, 100)
+    # a tiny memory limit forces the memmap path
+    memmapped = ActiveSelectionMaxSubset(None, None, None, distance_memory_limit_gb=1e-4)._max_representative_samples(image_features, candidate_features, 100)
+    print(in_memory == memmapped)
+
+
+def test_ann_selections():
+    features = np.random.normal(size=(5000, 32))
+    exact = ActiveSelectionCoreSet(None, None, None)._select_batch(features, list(range(500)), 30)
+    for backend, nprobe in [('ivf', 4), ('ivf', 1000), ('balltree', 8)]:
+        active_selection = ActiveSelectionCoreSet(None, None, None)
+        active_selection.set_ann_config(backend, nprobe=nprobe)
+        print(backend, nprobe, active_selection._select_batch(features, list(range(500)), 30) == exact)
+    image_features = np.random.normal(size=(3000, 16))
+    candidate_features = image_features[np.random.choice(3000, 400, replace=False)]
+    exact = ActiveSelectionMaxSubset(None, None, None)._max_representative_samples(image_features, candidate_features, 100)
+    max_subset_selector = ActiveSelectionMaxSubset(None, None, None)
+    max_subset_selector.set_ann_config('balltree', neighbors=20)
+    print(len(set(exact) & set(max_subset_selector._max_representative_samples(image_features, candidate_features, 100))))
+
+
+def test_kmeans_representatives():
+    from active_selection.kmeans import ActiveSelectionKMeans
+    from sklearn.metrics import pairwise_distances
+    centers = np.random.normal(size=(30, 64)) * 10
+    pool_features = centers[np.random.randint(0, 30, 20000)] + np.random.normal(size=(20000, 64))
+    candidate_features = pool_features[np.random.choice(20000, 600, replace=False)]
+    active_selection = ActiveSelectionKMeans(None, None, None)
+    kmeans = active_selection._fit_kmeans(iter(np.array_split(pool_features, 100)), 30)
+    selected_indices = active_selection._candidates_closest_to_centroids(kmeans.cluster_centers_, candidate_features)
+    # every true cluster should be represented once
+    print(len(set(np.argmin(pairwise_distances(candidate_features[selected_indices], centers), axis=1))))
+
+
+def test_budgeted_pool_order():
+    from active_selection.base import ActiveSelectionBase
+    from active_selection.budget import SelectionBudget
+    active_selection = ActiveSelectionBase(None, None, None)
+    active_selection.set_time_budget(SelectionBudget(0, min_items=10))
+    visited = []
+    for _ in range(2):
+        active_selection.time_budget.start()
+        visited.append(list(active_selection._budgeted(active_selection._pool_order(1000), 'scoring', 1000)))
+    # a pass cut short by the budget scores a different subsample every iteration
+    assert len(visited[0]) == 10 and visited[0] != visited[1]
+
+
+def test_kmeans_overlapping_clusters():
+    from active_selection.kmeans import ActiveSelectionKMeans
+    # centroids on top of each other share their closest candidates
+    centroids = np.random.normal(size=(40, 16)) * 0.01
+    candidate_features = np.random.normal(size=(200, 16))
+    active_selection = ActiveSelectionKMeans(None, None, None, neighbors_per_centroid=4)
+    selected = active_selection._candidates_closest_to_centroids(centroids, candidate_features, 50)
+    assert len(selected) == 50 and len(set(selected)) == 50
+
+
 def test_region_features():
     import matplotlib.pyplot as plt
     from dataloaders.dataset import region_cityscapes
@@ -1301,6 +1397,53 @@ def test_gradient_selection():
     print(active_selector.get_adversarially_vulnarable_samples(model, train_set.current_image_paths[:10], 5))
 
 
+def test_gradient_sensitivity_modes():
+    unet = torch.nn.Sequential(torch.nn.Conv2d(22, 8, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(8, 2, 3, padding=1))
+    unet_input = torch.randn(4, 22, 32, 32)
+    backward = ActiveSelectionAccuracy._gradient_sensitivity(unet, unet_input, 'backward')
+    # estimates are a different quantity, so compare image rankings rather than values
+    for mode in ['jvp', 'finite_difference']:
+        estimate = ActiveSelectionAccuracy._gradient_sensitivity(unet, unet_input, mode, num_probes=8)
+        print(mode, estimate.shape == backward.shape, backward.mean(dim=(1, 2)).argsort().tolist(), estimate.mean(dim=(1, 2)).argsort().tolist())
+
+
+def test_selection_handoff():
+    import tempfile
+    import threading
+    import time
+    from utils import selection_handoff
+    directory = tempfile.mkdtemp()
+    selections_file = os.path.join(directory, 'run_0010', 'selections.txt')
+
+    def producer():
+        time.sleep(1)
+        os.makedirs(os.path.dirname(selections_file))
+        selection_handoff.publish(directory, selections_file, ['a\n', 'b\n', 'c\n'])
+
+    threading.Thread(target=producer).start()
+    start_time = time.time()
+    active_selector = ActiveSelectionAccuracy(2, None, None, None)
+    print(active_selector.wait_for_selected_samples(selections_file, [b'c', b'a', b'd']), time.time() - start_time)
+
+
+def test_inference_model():
+    from models.inference import InferenceModel
+    model = torch.nn.DataParallel(DeepLab(num_classes=19, backbone='mobilenet', output_stride=16, sync_bn=False, freeze_bn=False))
+    model.eval()
+    images = torch.randn(2, 3, 128, 128)
+    with torch.no_grad():
+        eager = model(images)
+        for compile in [False, True]:
+            selection_model = InferenceModel(model, channels_last=True, compile=compile)
+            print(compile, (selection_model(images) - eager).abs().max().item())
+            # the feature path is checked against eager separately
+            model.module.set_return_features(True)
+            selection_model(images)
+            model.module.set_return_features(False)
+            print(selection_model.checked_signatures, selection_model.is_optimized)
+            selection_model.release()
+
+
 def test_unsure_samples():
     import matplotlib.pyplot as plt
     from dataloaders.utils import map_segmentations_to_colors, map_segmentation_to_colors, map_binary_output_mask_to_colors
@@ -1522,8 +1665,17 @@ if __name__ == '__main__':
     # test_visualize_feature_space()
     # test_core_set()
     # test_kcenter()
+    # test_kcenter_blockwise()
+    # test_kcenter_truncated_pool()
+    # test_feature_projection()
     # test_ceal()
     # test_max_set_cover()
+    # test_max_set_cover_greedy_modes()
+    # test_max_set_cover_memmap()
+    # test_ann_selections()
+    # test_kmeans_representatives()
+    # test_kmeans_overlapping_clusters()
+    # test_budgeted_pool_order()
     # test_region_features()
     # test_image_features()
     # test_entropy_map_for_images_with_noise_and_ve()
@@ -1531,6 +1683,9 @@ if __name__ == '__main__':
     # test_noisy_create_region_maps_with_region_cityscapes()
     # test_accuracy_est_selector()
     # test_gradient_selection()
+    # test_gradient_sensitivity_modes()
+    # test_selection_handoff()
+    # test_inference_model()
     # test_gradient_visualization()
     # test_unsure_samples()
     # test_create_region_maps_with_region_pascal()
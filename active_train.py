@@ -6,15 +6,21 @@ import math
 import random
 
 from dataloaders import make_dataloader
+from torch.utils.data import DataLoader
 from models.sync_batchnorm.replicate import patch_replication_callback
 
 from models.deeplab import *
 from utils.loss import SegmentationLosses
-from utils.calculate_weights import calculate_weights_labels
+from utils.calculate_weights import calculate_weights_labels, calculate_weights_from_frequencies
 from utils.lr_scheduler import LR_Scheduler
+from utils.train_budget import TrainingBudget
+from utils.proxy_validation import ProxyValidation
+from utils import amp
 from utils.saver import Saver, ActiveSaver
 from utils.summaries import TensorboardSummary
-from active_selection import get_active_selection_class, get_max_subset_active_selector
+from active_selection import get_active_selection_class, get_max_subset_active_selector, get_kmeans_active_selector
+from active_selection.feature_store import FeatureStore
+from active_selection.budget import SelectionBudget
 from utils.metrics import Evaluator
 import constants
 import sys
@@ -22,6 +28,7 @@ from utils.early_stop import EarlyStopChecker
 
 from models.enet import ENet
 from models.fastscnn import FastSCNN
+from models.inference import get_inference_model
 
 
 class Trainer(object):
@@ -30,31 +37,45 @@ class Trainer(object):
         self.args = args
         self.mc_dropout = mc_dropout
         self.train_loader, self.val_loader, self.test_loader, self.nclass = dataloaders
+        self.model = None
+        # weights of the best validation so far, kept in memory for selection and warm starts
+        self.best_state = None
 
-    def setup_saver_and_summary(self, num_current_labeled_samples, samples, experiment_group=None, regions=None):
+    def setup_saver_and_summary(self, num_current_labeled_samples, samples, experiment_group=None, regions=None, superpixels=None):
 
         self.saver = ActiveSaver(self.args, num_current_labeled_samples, experiment_group=experiment_group)
         self.saver.save_experiment_config()
-        self.saver.save_active_selections(samples, regions)
+        self.saver.save_active_selections(samples, regions, superpixels)
         self.summary = TensorboardSummary(self.saver.experiment_dir)
         self.writer = self.summary.create_summary()
 
-    def initialize(self):
+    def initialize(self, warm_start=False, epochs=None, max_steps=None):
 
         args = self.args
-
-        if args.architecture == 'deeplab':
+        epochs = args.epochs if epochs is None else epochs
+        self.max_steps = max_steps
+        warm_start = warm_start and self.model is not None
+
+        if warm_start:
+            # continue from the previous best weights, only the optimization state starts over
+            print('Warm starting from the previous best model')
+            if self.best_state is not None:
+                self.model.module.load_state_dict(self.best_state)
+            model = self.model.module
+        elif args.architecture == 'deeplab':
             print('Using Deeplab')
             model = DeepLab(num_classes=self.nclass, backbone=args.backbone, output_stride=args.out_stride, sync_bn=args.sync_bn, freeze_bn=args.freeze_bn)
-            train_params = [{'params': model.get_1x_lr_params(), 'lr': args.lr},
-                            {'params': model.get_10x_lr_params(), 'lr': args.lr * 10}]
         elif args.architecture == 'enet':
             print('Using ENet')
             model = ENet(num_classes=self.nclass, encoder_relu=True, decoder_relu=True)
-            train_params = [{'params': model.parameters(), 'lr': args.lr}]
         elif args.architecture == 'fastscnn':
             print('Using FastSCNN')
             model = FastSCNN(3, self.nclass)
+
+        if args.architecture == 'deeplab':
+            train_params = [{'params': model.get_1x_lr_params(), 'lr': args.lr},
+                            {'params': model.get_10x_lr_params(), 'lr': args.lr * 10}]
+        else:
             train_params = [{'params': model.parameters(), 'lr': args.lr}]
         if args.optimizer == 'SGD':
             optimizer = torch.optim.SGD(train_params, momentum=args.momentum, weight_decay=args.weight_decay, nesterov=args.nesterov)
@@ -64,27 +85,50 @@ class Trainer(object):
             raise NotImplementedError
 
         if args.use_balanced_weights:
-            weight = calculate_weights_labels(args.dataset, self.train_loader, self.nclass)
+            if hasattr(self.train_loader.dataset, 'get_class_frequencies'):
+                # running per class totals of the active datasets, no pass over the loader
+                weight = calculate_weights_from_frequencies(self.train_loader.dataset.get_class_frequencies())
+            else:
+                weight = calculate_weights_labels(args.dataset, self.train_loader, self.nclass)
             weight = torch.from_numpy(weight.astype(np.float32))
         else:
             weight = None
 
         self.criterion = SegmentationLosses(weight=weight, cuda=args.cuda).build_loss(mode=args.loss_type)
-        self.model, self.optimizer = model, optimizer
+        self.optimizer = optimizer
 
         self.evaluator = Evaluator(self.nclass)
 
         if args.use_lr_scheduler:
-            self.scheduler = LR_Scheduler(args.lr_scheduler, args.lr, args.epochs, len(self.train_loader))
+            # a step budget decays the learning rate over exactly its steps
+            scheduler_epochs = epochs if max_steps is None else max_steps / len(self.train_loader)
+            self.scheduler = LR_Scheduler(args.lr_scheduler, args.lr, scheduler_epochs, len(self.train_loader))
         else:
             self.scheduler = None
 
-        if args.cuda:
-            self.model = torch.nn.DataParallel(self.model, device_ids=self.args.gpu_ids)
-            patch_replication_callback(self.model)
-            self.model = self.model.cuda()
+        if not warm_start:
+            self.model = model
+            if args.cuda:
+                self.model = torch.nn.DataParallel(self.model, device_ids=self.args.gpu_ids)
+                patch_replication_callback(self.model)
+                self.model = self.model.cuda()
+
+        self.device_type = 'cuda' if args.cuda else 'cpu'
+        self.scaler = amp.make_grad_scaler(args.amp, self.device_type)
 
         self.best_pred = 0.0
+        self.best_state = None
+
+    def _checkpoint_state(self, epoch):
+
+        state = {
+            'epoch': epoch + 1,
+            'state_dict': self.model.module.state_dict(),
+            'best_pred': self.best_pred,
+        }
+        if not self.args.no_checkpoint_optimizer:
+            state['optimizer'] = self.optimizer.state_dict()
+        return state
 
     def training(self, epoch):
 
@@ -92,8 +136,12 @@ class Trainer(object):
         self.model.train()
         num_img_tr = len(self.train_loader)
         tbar = tqdm(self.train_loader, desc='\r')
+        throughput = amp.ThroughputMeter(self.args.cuda)
+        throughput.start()
 
         for i, sample in enumerate(tbar):
+            if self.max_steps is not None and i > 0 and i + num_img_tr * epoch >= self.max_steps:
+                break
             image, target = sample['image'], sample['label']
             if self.args.cuda:
                 image, target = image.cuda(), target.cuda()
@@ -101,14 +149,22 @@ class Trainer(object):
                 self.scheduler(self.optimizer, i, epoch, self.best_pred)
                 self.writer.add_scalar('train/learning_rate', self.scheduler.current_lr, i + num_img_tr * epoch)
             self.optimizer.zero_grad()
-            output = self.model(image)
-            loss = self.criterion(output, target)
-            loss.backward()
-            self.optimizer.step()
+            with amp.autocast(self.args.amp, self.device_type):
+                output = self.model(image)
+            # the loss is reduced in float32
+            loss = self.criterion(output.float(), target)
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            throughput.update(image.shape[0])
             train_loss += loss.item()
             tbar.set_description('Train loss: %.3f' % (train_loss / (i + 1)))
             self.writer.add_scalar('train/total_loss_iter', loss.item(), i + num_img_tr * epoch)
 
+        images_per_second, peak_memory_gb = throughput.stop()
+        self.writer.add_scalar('train/images_per_second', images_per_second, epoch)
+        self.writer.add_scalar('train/peak_memory_gb', peak_memory_gb, epoch)
+
         self.writer.add_scalar('train/total_loss_epoch', train_loss, epoch)
         print('[Epoch: %d, numImages: %5d]' % (epoch, i * self.args.batch_size + image.data.shape[0]))
         print('Loss: %.3f' % train_loss)
@@ -117,15 +173,28 @@ class Trainer(object):
         if self.args.no_val:
             # save checkpoint every epoch
             is_best = False
-            self.saver.save_checkpoint({
-                'epoch': epoch + 1,
-                'state_dict': self.model.module.state_dict(),
-                'optimizer': self.optimizer.state_dict(),
-                'best_pred': self.best_pred,
-            }, is_best)
+            self.saver.save_checkpoint(self._checkpoint_state(epoch), is_best)
 
         return train_loss
 
+    def proxy_validation(self, epoch, loader):
+
+        self.model.eval()
+        self.evaluator.reset()
+
+        for sample in tqdm(loader, desc='\r'):
+            image, target = sample['image'], sample['label']
+            if self.args.cuda:
+                image, target = image.cuda(), target.cuda()
+            with torch.no_grad():
+                output = amp.forward(self.model, image, self.args.amp, self.device_type)
+            self.evaluator.add_batch(target, output.argmax(1))
+
+        mIoU = self.evaluator.Mean_Intersection_over_Union()
+        self.writer.add_scalar('val/proxy_mIoU', mIoU, epoch)
+        print(f'Proxy validation mIoU: {mIoU}')
+        return mIoU
+
     def validation(self, epoch):
 
         self.model.eval()
@@ -146,7 +215,7 @@ class Trainer(object):
                 image, target = image.cuda(), target.cuda()
 
             with torch.no_grad():
-                output = self.model(image)
+                output = amp.forward(self.model, image, self.args.amp, self.device_type)
 
             if i == visualization_index:
                 vis_img = image
@@ -156,9 +225,7 @@ class Trainer(object):
             loss = self.criterion(output, target)
             test_loss += loss.item()
             tbar.set_description('Test loss: %.3f' % (test_loss / (i + 1)))
-            pred = output.data.cpu().numpy()
-            target = target.cpu().numpy()
-            pred = np.argmax(pred, axis=1)
+            pred = output.argmax(1)
 
             self.evaluator.add_batch(target, pred)
 
@@ -182,14 +249,10 @@ class Trainer(object):
         if new_pred > self.best_pred:
             is_best = True
             self.best_pred = new_pred
+            self.best_state = {k: v.detach().cpu().clone() for k, v in self.model.module.state_dict().items()}
 
         # save every validation model (overwrites)
-        self.saver.save_checkpoint({
-            'epoch': epoch + 1,
-            'state_dict': self.model.module.state_dict(),
-            'optimizer': self.optimizer.state_dict(),
-            'best_pred': self.best_pred,
-        }, is_best)
+        self.saver.save_checkpoint(self._checkpoint_state(epoch), is_best)
 
         return test_loss, mIoU, Acc, Acc_class, FWIoU, [vis_img, vis_tgt, vis_out]
 
@@ -276,8 +339,62 @@ def main():
     parser.add_argument('--active-batch-size', type=int, default=50,
                         help='batch size queried from oracle')
     parser.add_argument('--active-selection-mode', type=str, default='random',
-                        choices=['random', 'variance', 'coreset', 'ceal_confidence', 'ceal_margin', 'ceal_entropy', 'ceal_fusion', 'ceal_entropy_weakly_labeled', 'variance_representative', 'noise_image', 'noise_feature', 'noise_variance', 'accuracy_labels', 'accuracy_eval'], help='method to select new samples')
+                        choices=['random', 'variance', 'coreset', 'ceal_confidence', 'ceal_margin', 'ceal_entropy', 'ceal_fusion', 'ceal_entropy_weakly_labeled', 'variance_representative', 'variance_kmeans', 'noise_image', 'noise_feature', 'noise_variance', 'accuracy_labels', 'accuracy_eval'], help='method to select new samples')
     parser.add_argument('--active-region-size', type=int, default=129, help='size of regions in case region dataset is used')
+    parser.add_argument('--region-unit', type=str, default='square', choices=['square', 'superpixel'],
+                        help='region primitive for region datasets, superpixels need utils/superpixels.py to be run first (default: square)')
+    parser.add_argument('--region-crop-margin', type=int, default=None,
+                        help='train region datasets on crops around labeled regions with this context margin (default: full frames)')
+    parser.add_argument('--region-crop-batch-size', type=int, default=None,
+                        help='batch size for region crops (default: auto, keeps pixels per batch close to full frames)')
+    parser.add_argument('--coreset-half-precision', action='store_true', default=False, help='store coreset features in float16')
+    parser.add_argument('--coreset-static-embedding', type=str, default='none', choices=['none', 'initial', 'imagenet'],
+                        help='run coreset on a fixed embedding (first model or imagenet backbone), persisted in the experiment directory, '
+                             'and keep distances to the labeled set across iterations (default: none, current model)')
+    parser.add_argument('--feature-projection', type=str, default='none', choices=['none', 'random', 'pca'],
+                        help='project coreset / max subset features to a lower dimension before computing distances (default: none)')
+    parser.add_argument('--max-subset-greedy', type=str, default='lazy', choices=['exact', 'lazy', 'stochastic'],
+                        help='greedy variant for representativeness selection, exact and lazy give the same selections (default: lazy)')
+    parser.add_argument('--max-subset-distance-dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='storage type of the representativeness distance matrix (default: float32)')
+    parser.add_argument('--max-subset-memory-limit', type=float, default=4.0,
+                        help='distance matrices larger than this many GB are kept in a memmap on disk (default: 4)')
+    parser.add_argument('--max-subset-cache-dir', type=str, default=None, help='directory for distance memmaps (default: system temp dir)')
+    parser.add_argument('--ann-backend', type=str, default='none', choices=['none', 'ivf', 'balltree'],
+                        help='approximate nearest neighbours for coreset center queries and max subset coverage (default: none, exact)')
+    parser.add_argument('--ann-lists', type=int, default=None, help='number of ivf lists (default: sqrt of the indexed points)')
+    parser.add_argument('--ann-nprobe', type=int, default=8, help='ivf lists scanned per query, higher is more accurate (default: 8)')
+    parser.add_argument('--ann-neighbors', type=int, default=20, help='candidates covering each image in max subset selection with ann (default: 20)')
+    parser.add_argument('--ann-recall-sample', type=int, default=256, help='queries used to report ann recall against brute force, 0 disables (default: 256)')
+    parser.add_argument('--selection-time-budget', type=float, default=None,
+                        help='wall clock seconds per active selection, selectors return their best selection so far when it runs out (default: unbounded)')
+    parser.add_argument('--no-feature-store', action='store_true', default=False,
+                        help='recompute features in every selector instead of sharing pooled embeddings within an iteration')
+    parser.add_argument('--feature-projection-dim', type=int, default=128, help='dimension of projected features (default: 128)')
+    parser.add_argument('--no-checkpoint-optimizer', action='store_true', default=False,
+                        help='leave the optimizer state out of checkpoints, they are about half the size for SGD with momentum')
+    parser.add_argument('--proxy-val-size', type=int, default=None,
+                        help='validate on a class stratified subset of this many val images and run the full split only when it is '
+                             'close to its best, early stopping follows the subset (default: always full validation)')
+    parser.add_argument('--proxy-val-margin', type=float, default=0.02, help='proxy mIoU margin below its best that still triggers full validation (default: 0.02)')
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='mixed precision training and selection, float16 with loss scaling on gpu, bfloat16 on cpu')
+    parser.add_argument('--inference-channels-last', action='store_true', default=False,
+                        help='run selection models in channels_last memory format, checked against eager outputs on the first batch')
+    parser.add_argument('--inference-compile', action='store_true', default=False,
+                        help='torch.compile selection models, falls back to eager when unavailable, failing or inexact')
+    parser.add_argument('--warm-start', action='store_true', default=False,
+                        help='fine-tune the previous iteration\'s best model in memory instead of training from scratch every iteration')
+    parser.add_argument('--warm-start-epochs', type=int, default=None,
+                        help='epochs of warm started iterations, all but the first (default: --epochs)')
+    parser.add_argument('--train-steps', type=int, default=None,
+                        help='optimizer steps per active iteration at the reference labeled set size, replaces --epochs and --eval-interval (default: epoch based)')
+    parser.add_argument('--train-steps-reference', type=int, default=None, help='labeled images that get --train-steps steps (default: first labeled set)')
+    parser.add_argument('--train-steps-exponent', type=float, default=0.5,
+                        help='steps grow with (labeled images / reference) ^ exponent, 1 behaves like fixed epochs (default: 0.5)')
+    parser.add_argument('--train-steps-min', type=int, default=None, help='lower bound on steps per active iteration')
+    parser.add_argument('--train-steps-max', type=int, default=None, help='upper bound on steps per active iteration')
+    parser.add_argument('--train-evaluations', type=int, default=10, help='validations per active iteration with --train-steps (default: 10)')
     parser.add_argument('--max-iterations', type=int, default=1000, help='maximum active selection iterations')
     parser.add_argument('--min-improvement', type=float, default=0.01, help='min improvement evaluation interval (default: 1)')
     parser.add_argument('--weak-label-entropy-threshold', type=float, default=0.80, help='initial threshold for entropy for weak labels')
@@ -296,6 +413,10 @@ def main():
         except ValueError:
             raise ValueError('Argument --gpu_ids must be a comma-separated list of integers only')
 
+    # superpixels are generated in the padded square space, full size cityscapes labels keep the 1:2 aspect
+    assert not (args.dataset == 'active_cityscapes_region' and args.region_unit == 'superpixel' and args.crop_size == -1), \
+        'superpixel regions on cityscapes need a crop size, --crop-size -1 is not supported'
+
     if args.sync_bn is None:
         if args.cuda and len(args.gpu_ids) > 1:
             args.sync_bn = True
@@ -330,8 +451,8 @@ def main():
     if args.checkname is None:
         args.checkname = 'deeplab-' + str(args.backbone)
 
-    mc_dropout = args.active_selection_mode == 'variance' or args.active_selection_mode == 'variance_representative' or args.active_selection_mode == 'noise_variance'
-    args.active_batch_size = args.active_batch_size * 2 if args.active_selection_mode == 'variance_representative' else args.active_batch_size
+    mc_dropout = args.active_selection_mode in ['variance', 'variance_representative', 'variance_kmeans', 'noise_variance']
+    args.active_batch_size = args.active_batch_size * 2 if args.active_selection_mode in ['variance_representative', 'variance_kmeans'] else args.active_batch_size
 
     print()
     print(args)
@@ -348,6 +469,20 @@ def main():
     training_set = dataloaders[0]
     dataloaders = dataloaders[1:]
 
+    train_batch_size = args.batch_size
+    if args.region_crop_margin is not None:
+        assert args.dataset.endswith('_region'), 'region crops are only supported for region datasets'
+        training_set.set_region_crop_mode(args.active_region_size, args.region_crop_margin)
+        if args.region_crop_batch_size is None:
+            image_size = args.base_size if args.crop_size == -1 else args.crop_size
+            args.region_crop_batch_size = args.batch_size * max(1, image_size ** 2 // (args.active_region_size + 2 * args.region_crop_margin) ** 2)
+        train_batch_size = args.region_crop_batch_size
+        # same loader configuration as make_dataloader's, only the batch size changes
+        train_loader = dataloaders[0]
+        dataloaders = (DataLoader(training_set, batch_size=train_batch_size, shuffle=True, num_workers=train_loader.num_workers, pin_memory=train_loader.pin_memory,
+                                  collate_fn=train_loader.collate_fn, drop_last=train_loader.drop_last, timeout=train_loader.timeout,
+                                  worker_init_fn=train_loader.worker_init_fn),) + dataloaders[1:]
+
     saver = Saver(args, remove_existing=False)
     saver.save_experiment_config()
 
@@ -356,8 +491,50 @@ def main():
 
     print()
 
-    active_selector = get_active_selection_class(args.active_selection_mode, training_set.NUM_CLASSES, training_set.env, args.crop_size, args.batch_size)
-    max_subset_selector = get_max_subset_active_selector(training_set.env, args.crop_size, args.batch_size)  # used only for representativeness cases
+    active_selector = get_active_selection_class(args.active_selection_mode, training_set.NUM_CLASSES, training_set.env, args.crop_size, args.batch_size,
+                                                 coreset_half_precision=args.coreset_half_precision,
+                                                 feature_projection=args.feature_projection, feature_projection_dim=args.feature_projection_dim)
+    # used only for representativeness cases
+    if args.active_selection_mode == 'variance_kmeans':
+        max_subset_selector = get_kmeans_active_selector(training_set.env, args.crop_size, args.batch_size,
+                                                         feature_projection=args.feature_projection, feature_projection_dim=args.feature_projection_dim)
+    else:
+        max_subset_selector = get_max_subset_active_selector(training_set.env, args.crop_size, args.batch_size, greedy_mode=args.max_subset_greedy,
+                                                             distance_dtype=args.max_subset_distance_dtype, distance_memory_limit_gb=args.max_subset_memory_limit,
+                                                             distance_cache_dir=args.max_subset_cache_dir,
+                                                             feature_projection=args.feature_projection, feature_projection_dim=args.feature_projection_dim)
+
+    if args.active_selection_mode == 'coreset' and args.coreset_static_embedding != 'none':
+        embedding_model = None
+        if args.coreset_static_embedding == 'imagenet':
+            assert args.architecture == 'deeplab', 'imagenet embedding needs a pretrained backbone'
+            embedding_model = DeepLab(num_classes=training_set.NUM_CLASSES, backbone=args.backbone, output_stride=args.out_stride, sync_bn=False, pretrained=True)
+            embedding_model = torch.nn.DataParallel(embedding_model, device_ids=args.gpu_ids).cuda()
+            embedding_model.eval()
+        active_selector.set_static_embedding(args.coreset_static_embedding, os.path.join(saver.experiment_dir, f'coreset_embedding_{args.coreset_static_embedding}.npz'),
+                                             embedding_model)
+
+    for selector in [active_selector, max_subset_selector]:
+        selector.set_amp(args.amp)
+
+    selection_budget = None
+    if args.selection_time_budget is not None:
+        selection_budget = SelectionBudget(args.selection_time_budget)
+        active_selector.set_time_budget(selection_budget)
+        max_subset_selector.set_time_budget(selection_budget)
+
+    if args.ann_backend != 'none':
+        for selector in [active_selector, max_subset_selector]:
+            selector.set_ann_config(args.ann_backend, n_lists=args.ann_lists, nprobe=args.ann_nprobe, neighbors=args.ann_neighbors,
+                                    recall_sample_size=args.ann_recall_sample)
+
+    feature_store = None
+    if args.active_selection_mode in ['coreset', 'variance_representative', 'variance_kmeans'] and not args.no_feature_store:
+        # pooled embeddings of the current checkpoint, shared by the selectors and reset after every training round
+        feature_store = FeatureStore(training_set.env, args.crop_size, args.batch_size, training_set.image_paths, cache_dir=args.max_subset_cache_dir,
+                                     amp=args.amp)
+        active_selector.set_feature_store(feature_store)
+        max_subset_selector.set_feature_store(feature_store)
 
     total_active_selection_iterations = min(len(training_set.image_paths) // args.active_batch_size - 1, args.max_iterations)
 
@@ -369,6 +546,18 @@ def main():
         assert len(training_set) == (args.resume * args.active_batch_size + seed_size)
 
     assert args.eval_interval <= args.epochs and args.epochs % args.eval_interval == 0
+    if args.warm_start_epochs is None:
+        args.warm_start_epochs = args.epochs
+    assert args.eval_interval <= args.warm_start_epochs and args.warm_start_epochs % args.eval_interval == 0
+
+    training_budget = None
+    if args.train_steps is not None:
+        training_budget = TrainingBudget(args.train_steps, reference_size=args.train_steps_reference, exponent=args.train_steps_exponent,
+                                         min_steps=args.train_steps_min, max_steps=args.train_steps_max, evaluations=args.train_evaluations)
+
+    proxy_validation = None
+    if args.proxy_val_size is not None:
+        proxy_validation = ProxyValidation(dataloaders[1], training_set.NUM_CLASSES, args.proxy_val_size, args.proxy_val_margin, seed=args.seed)
 
     trainer = Trainer(args, dataloaders, mc_dropout)
     trainer.initialize()
@@ -383,15 +572,30 @@ def main():
             trainer.setup_saver_and_summary(fraction_of_data_labeled, training_set.current_image_paths)
         elif args.dataset.endswith('_region'):
             trainer.setup_saver_and_summary(fraction_of_data_labeled, training_set.current_image_paths, regions=[
-                                            training_set.current_paths_to_regions_map[x] for x in training_set.current_image_paths])
+                                            training_set.current_paths_to_regions_map[x] for x in training_set.current_image_paths], superpixels=[
+                                            training_set.current_paths_to_superpixels_map.get(x, []) for x in training_set.current_image_paths])
         else:
             raise NotImplementedError
 
         len_dataset_before = len(training_set)
-        training_set.make_dataset_multiple_of_batchsize(args.batch_size)
+        # region crop mode counts crops in len(), the training budget follows labeled images in every mode
+        num_labeled_images = len(training_set.current_image_paths)
+        training_set.make_dataset_multiple_of_batchsize(train_batch_size)
         print(f'\nExpanding training set with {len_dataset_before}  images to {len(training_set)} images')
 
-        trainer.initialize()
+        # the first iteration of a run always starts from pretrained weights
+        warm_start = args.warm_start and selection_iter > args.resume
+        epochs = args.warm_start_epochs if warm_start else args.epochs
+        eval_interval, max_steps = args.eval_interval, None
+        if training_budget is not None:
+            # warm started iterations get the same share of the budget as of the epochs
+            steps = training_budget.steps(num_labeled_images) * (args.warm_start_epochs / args.epochs if warm_start else 1)
+            epochs, eval_interval, max_steps = training_budget.schedule(steps, len(trainer.train_loader))
+            print(f'Training {max_steps} steps ({epochs} epochs, validating every {eval_interval}) on {num_labeled_images} labeled images')
+            writer.add_scalar('active_loop/train_steps', max_steps, fraction_of_data_labeled)
+        trainer.initialize(warm_start=warm_start, epochs=epochs, max_steps=max_steps)
+        if proxy_validation is not None:
+            proxy_validation.reset()
 
         if not args.no_early_stop:
             early_stop = EarlyStopChecker(patience=5, min_improvement=args.min_improvement)
@@ -401,24 +605,32 @@ def main():
         best_Acc_class = 0
         best_FWIoU = 0
 
-        for outer_epoch in range(args.epochs // args.eval_interval):
+        for outer_epoch in range(math.ceil(epochs / eval_interval)):
             train_loss = 0
-            for inner_epoch in range(args.eval_interval):
-                train_loss += trainer.training(outer_epoch * args.eval_interval + inner_epoch)
-            test_loss, mIoU, Acc, Acc_class, FWIoU, visualizations = trainer.validation(outer_epoch * args.eval_interval + inner_epoch)
-            if mIoU > best_mIoU:
-                best_mIoU = mIoU
-            if Acc > best_Acc:
-                best_Acc = Acc
-            if Acc_class > best_Acc_class:
-                best_Acc_class = Acc_class
-            if FWIoU > best_FWIoU:
-                best_FWIoU = FWIoU
+            for inner_epoch in range(min(eval_interval, epochs - outer_epoch * eval_interval)):
+                train_loss += trainer.training(outer_epoch * eval_interval + inner_epoch)
+            run_full_validation = True
+            if proxy_validation is not None:
+                # the first proxy validation of a round always escalates, so there is a full one to report
+                stop_score = trainer.proxy_validation(outer_epoch * eval_interval + inner_epoch, proxy_validation.loader)
+                run_full_validation = proxy_validation.escalate(stop_score)
+            if run_full_validation:
+                test_loss, mIoU, Acc, Acc_class, FWIoU, visualizations = trainer.validation(outer_epoch * eval_interval + inner_epoch)
+                if mIoU > best_mIoU:
+                    best_mIoU = mIoU
+                if Acc > best_Acc:
+                    best_Acc = Acc
+                if Acc_class > best_Acc_class:
+                    best_Acc_class = Acc_class
+                if FWIoU > best_FWIoU:
+                    best_FWIoU = FWIoU
+                if proxy_validation is None:
+                    stop_score = mIoU
 
             if not args.no_early_stop:
                 # check for early stopping
-                if early_stop(mIoU):
-                    print(f'Early stopping triggered after {outer_epoch * args.eval_interval + inner_epoch} epochs')
+                if early_stop(stop_score):
+                    print(f'Early stopping triggered after {outer_epoch * eval_interval + inner_epoch} epochs')
                     break
 
         training_set.reset_dataset()
@@ -433,31 +645,52 @@ def main():
         summary.visualize_image(writer, args.dataset, visualizations[0], visualizations[1], visualizations[2], len(training_set.current_image_paths))
 
         trainer.writer.close()
+        trainer.saver.flush()
 
         if selection_iter == (total_active_selection_iterations - 1):
             break
 
-        checkpoint = torch.load(os.path.join(trainer.saver.experiment_dir, 'best.pth.tar'))
-        trainer.model.module.load_state_dict(checkpoint['state_dict'])
+        if trainer.best_state is not None:
+            trainer.model.module.load_state_dict(trainer.best_state)
+        else:
+            checkpoint = torch.load(os.path.join(trainer.saver.experiment_dir, 'best.pth.tar'))
+            trainer.model.module.load_state_dict(checkpoint['state_dict'])
 
         trainer.model.eval()
+        selection_model = trainer.model
+        if args.inference_channels_last or args.inference_compile:
+            selection_model = get_inference_model(selection_model, (trainer.saver.experiment_dir, trainer.best_pred),
+                                                  channels_last=args.inference_channels_last, compile=args.inference_compile)
+
+        if feature_store is not None:
+            feature_store.reset()
+        if selection_budget is not None:
+            selection_budget.start()
 
         if args.active_selection_mode == 'random':
             training_set.expand_training_set(active_selector.get_random_uncertainity(training_set.remaining_image_paths, args.active_batch_size))
-        elif args.active_selection_mode == 'variance' or args.active_selection_mode == 'variance_representative':
+        elif args.active_selection_mode in ['variance', 'variance_representative', 'variance_kmeans']:
             if args.dataset.endswith('_image'):
                 print('Calculating entropies..')
-                selected_images = active_selector.get_vote_entropy_for_images(trainer.model, training_set.remaining_image_paths, args.active_batch_size)
-                if args.active_selection_mode == 'variance_representative':
-                    selected_images = max_subset_selector.get_representative_images(trainer.model, training_set.image_paths, selected_images)
+                selected_images = active_selector.get_vote_entropy_for_images(selection_model, training_set.remaining_image_paths, args.active_batch_size)
+                if args.active_selection_mode in ['variance_representative', 'variance_kmeans']:
+                    selected_images = max_subset_selector.get_representative_images(selection_model, training_set.image_paths, selected_images)
                 training_set.expand_training_set(selected_images)
+            elif args.dataset.endswith('_region') and args.region_unit == 'superpixel':
+                assert args.active_selection_mode == 'variance', 'superpixel regions are only supported for variance selection'
+                print('Creating superpixel maps..')
+                superpixels, labeled_pixels = active_selector.create_superpixel_maps(
+                    selection_model, training_set.image_paths, training_set.get_existing_region_maps(), training_set.get_existing_superpixel_maps(),
+                    training_set.get_superpixel_env(), args.active_batch_size)
+                print(f'Got {sum([len(x) for x in superpixels.values()])} superpixels covering {labeled_pixels} pixels')
+                training_set.expand_training_set_with_superpixels(superpixels, labeled_pixels)
             elif args.dataset.endswith('_region'):
                 print('Creating region maps..')
                 regions, counts = active_selector.create_region_maps(
-                    trainer.model, training_set.image_paths, training_set.get_existing_region_maps(), args.active_region_size, args.active_batch_size)
+                    selection_model, training_set.image_paths, training_set.get_existing_region_maps(), args.active_region_size, args.active_batch_size)
 
-                if args.active_selection_mode == 'variance_representative':
-                    regions, counts = max_subset_selector.get_representative_regions(trainer.model, training_set.image_paths, regions, args.active_region_size)
+                if args.active_selection_mode in ['variance_representative', 'variance_kmeans']:
+                    regions, counts = max_subset_selector.get_representative_regions(selection_model, training_set.image_paths, regions, args.active_region_size)
                 print(f'Got {counts}/{math.ceil((args.active_batch_size) * args.crop_size * args.crop_size / (args.active_region_size * args.active_region_size))} regions')
                 training_set.expand_training_set(regions, counts * args.active_region_size * args.active_region_size)
             else:
@@ -465,24 +698,24 @@ def main():
         elif args.active_selection_mode == 'coreset':
             assert args.dataset.endswith('_image'), 'only images supported for coreset approach'
             training_set.expand_training_set(active_selector.get_k_center_greedy_selections(
-                args.active_batch_size, trainer.model, training_set.remaining_image_paths, training_set.current_image_paths))
+                args.active_batch_size, selection_model, training_set.remaining_image_paths, training_set.current_image_paths))
         elif args.active_selection_mode == 'ceal_confidence':
             training_set.expand_training_set(active_selector.get_least_confident_samples(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size))
+                selection_model, training_set.remaining_image_paths, args.active_batch_size))
         elif args.active_selection_mode == 'ceal_margin':
             training_set.expand_training_set(active_selector.get_least_margin_samples(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size))
+                selection_model, training_set.remaining_image_paths, args.active_batch_size))
         elif args.active_selection_mode == 'ceal_entropy':
             training_set.expand_training_set(active_selector.get_maximum_entropy_samples(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size)[0])
+                selection_model, training_set.remaining_image_paths, args.active_batch_size)[0])
         elif args.active_selection_mode == 'ceal_fusion':
             training_set.expand_training_set(active_selector.get_fusion_of_confidence_margin_entropy_samples(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size))
+                selection_model, training_set.remaining_image_paths, args.active_batch_size))
         elif args.active_selection_mode == 'ceal_entropy_weakly_labeled':
             selected_samples, entropies = active_selector.get_maximum_entropy_samples(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size)
+                selection_model, training_set.remaining_image_paths, args.active_batch_size)
             training_set.clear_weak_labels()
-            weak_labels = active_selector.get_weakly_labeled_data(trainer.model, training_set.remaining_image_paths,
+            weak_labels = active_selector.get_weakly_labeled_data(selection_model, training_set.remaining_image_paths,
                                                                   args.weak_label_entropy_threshold - selection_iter * args.weak_label_threshold_decay, entropies)
             for sample in selected_samples:
                 if sample in weak_labels:
@@ -493,29 +726,29 @@ def main():
         elif args.active_selection_mode == 'noise_image':
             print('Calculating entropies..')
             selected_images = active_selector.get_vote_entropy_for_images_with_input_noise(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size)
+                selection_model, training_set.remaining_image_paths, args.active_batch_size)
             training_set.expand_training_set(selected_images)
         elif args.active_selection_mode == 'noise_feature':
             print('Calculating entropies..')
             selected_images = active_selector.get_vote_entropy_for_images_with_feature_noise(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size)
+                selection_model, training_set.remaining_image_paths, args.active_batch_size)
             training_set.expand_training_set(selected_images)
         elif args.active_selection_mode == 'noise_variance':
             if args.dataset.endswith('_image'):
                 print('Calculating entropies..')
                 selected_images = active_selector.get_vote_entropy_for_batch_with_noise_and_vote_entropy(
-                    trainer.model, training_set.remaining_image_paths, args.active_batch_size)
+                    selection_model, training_set.remaining_image_paths, args.active_batch_size)
                 training_set.expand_training_set(selected_images)
             elif args.dataset.endswith('_region'):
                 print('Creating region maps..')
                 regions, counts = active_selector.create_region_maps(
-                    trainer.model, training_set.image_paths, training_set.get_existing_region_maps(), args.active_region_size, args.active_batch_size)
+                    selection_model, training_set.image_paths, training_set.get_existing_region_maps(), args.active_region_size, args.active_batch_size)
                 print(f'Got {counts}/{math.ceil((args.active_batch_size) * args.crop_size * args.crop_size / (args.active_region_size * args.active_region_size))} regions')
                 training_set.expand_training_set(regions, counts * args.active_region_size * args.active_region_size)
         elif args.active_selection_mode == 'accuracy_labels':
             print('Evaluating accuracies..')
             selected_images = active_selector.get_least_accurate_sample_using_labels(
-                trainer.model, training_set.remaining_image_paths, args.active_batch_size)
+                selection_model, training_set.remaining_image_paths, args.active_batch_size)
             training_set.expand_training_set(selected_images)
         elif args.active_selection_mode == 'accuracy_eval':
             full_monitor_directory = os.path.join(constants.RUNS, args.dataset, args.monitor_directory)
@@ -526,6 +759,15 @@ def main():
         else:
             raise NotImplementedError
 
+        if selection_model is not trainer.model:
+            selection_model.release()
+
+        if selection_budget is not None:
+            # recorded with the run the selection was made from
+            trainer.saver.save_selection_report(selection_budget.report())
+
+    if feature_store is not None:
+        feature_store.close()
     writer.close()
 
 if __name__ == "__main__":
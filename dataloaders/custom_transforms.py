@@ -297,6 +297,63 @@ class FixScaleCropImageOnly(object):
         return sample
 
 
+class ScaleCropWithPrescaledLabel(object):
+    """Scale/crop only the image of a sample whose label is already in the scaled space."""
+
+    def __init__(self, image_scalecrop):
+        self.image_scalecrop = image_scalecrop
+
+    def __call__(self, sample):
+        return {'image': self.image_scalecrop(sample['image']),
+                'label': sample['label']}
+
+
+class RegionCrop(object):
+    """Crop a scaled sample to a window around a labeled region.
+
+    Args:
+        window (tuple): (row, col, size) of the square crop in the scaled space.
+        core (tuple): (row, col, height, width) of the labeled tile inside the window, labels
+        outside of it are set to the ignore index so the margin only serves as context.
+    """
+
+    def __init__(self, window, core, ignore_index=255):
+        self.window = window
+        self.core = core
+        self.ignore_index = ignore_index
+
+    def __call__(self, sample):
+        img = sample['image']
+        mask = sample['label']
+        r, c, size = self.window
+        cr, cc, ch, cw = self.core
+
+        img = img[r: r + size, c: c + size]
+        out_mask = np.ones((size, size), dtype=mask.dtype) * self.ignore_index
+        out_mask[cr - r: cr - r + ch, cc - c: cc - c + cw] = mask[cr: cr + ch, cc: cc + cw]
+
+        return {'image': img,
+                'label': out_mask}
+
+
+def get_region_crop_windows(regions, region_size, margin, image_shape):
+    """Tile labeled regions into region_size cores and place a (region_size + 2 * margin) window around each,
+    shifted to stay inside the scaled image. Returns a list of (window, core) tuples for RegionCrop."""
+
+    h, w = image_shape
+    size = min(region_size + 2 * margin, h, w)
+    windows = []
+    for region in regions:
+        r1, c1 = min(region[0] + region[2], h), min(region[1] + region[3], w)
+        for r in range(region[0], r1, region_size):
+            for c in range(region[1], c1, region_size):
+                core = (r, c, min(region_size, r1 - r), min(region_size, c1 - c))
+                window_r = min(max(r - margin, 0), h - size)
+                window_c = min(max(c - margin, 0), w - size)
+                windows.append(((window_r, window_c, size), core))
+    return windows
+
+
 def invert_fix_scale_crop(label, output, region, crop_size):
 
     h, w = label.shape
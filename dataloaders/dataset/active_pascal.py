@@ -12,6 +12,7 @@ from dataloaders.dataset import pascal_base
 from torch.utils import data
 import constants
 from tqdm import tqdm
+from utils.calculate_weights import label_histogram
 
 
 class ActivePascalImage(pascal_base.ActivePascalBase):
@@ -20,12 +21,13 @@ class ActivePascalImage(pascal_base.ActivePascalBase):
 
         super(ActivePascalImage, self).__init__(path, base_size, crop_size, split, overfit)
         self.current_image_paths = self.image_paths
-        self.remaining_image_paths = []
+        self.labeled_mask[:] = True
         if self.split == 'train':
             with open(os.path.join(self.path, 'seed_sets', init_set), "r") as fptr:
-                self.current_image_paths = [u'{}'.format(x.strip()).encode('ascii') for x in fptr.readlines() if x is not '']
-                self.remaining_image_paths = [x for x in self.image_paths if x not in self.current_image_paths]
-                print(f'# of current_image_paths = {len(self.current_image_paths)}, # of remaining_image_paths = {len(self.remaining_image_paths)}')
+                self.current_image_paths = [u'{}'.format(x.strip()).encode('ascii') for x in fptr.readlines() if x.strip() != '']
+                self.labeled_mask[:] = False
+                self.labeled_mask[self.get_ids([x for x in self.current_image_paths if x in self.path_to_id])] = True
+                print(f'# of current_image_paths = {len(self.current_image_paths)}, # of remaining_image_paths = {len(self.get_remaining_ids())}')
 
         self.labeled_pixel_count = len(self.current_image_paths) * self.base_size * self.base_size
         self.memory_hog_mode = memory_hog_mode
@@ -52,7 +54,7 @@ class ActivePascalImage(pascal_base.ActivePascalBase):
 
         img_path = self.current_image_paths[index] if not is_weakly_labeled else self.weakly_labeled_image_paths[index - len(self.current_image_paths)]
 
-        assert not (img_path in self.weakly_labeled_image_paths and img_path in self.current_image_paths), "weakly labeled image exists in already labeled samples"
+        assert not (is_weakly_labeled and self.labeled_mask[self.path_to_id[img_path]]), "weakly labeled image exists in already labeled samples"
 
         loaded_npy = None
 
@@ -76,20 +78,32 @@ class ActivePascalImage(pascal_base.ActivePascalBase):
 
         return retval
 
+    @property
+    def remaining_image_paths(self):
+        return self.get_paths(self.get_remaining_ids())
+
     def expand_training_set(self, paths):
+        ids = self.get_ids(paths)
+        assert not self.labeled_mask[ids].any(), "expanding with already labeled samples"
+        self.labeled_mask[ids] = True
         self.current_image_paths.extend(paths)
-        for x in paths:
-            self.remaining_image_paths.remove(x)
+        if self.labeled_class_frequencies is not None:
+            for x in paths:
+                self.labeled_class_frequencies += self.get_class_histogram(x)
         self.labeled_pixel_count = len(self.current_image_paths) * self.base_size * self.base_size
 
     def add_weak_labels(self, predictions_dict):
         print(f'Adding {len(predictions_dict.keys())} weak labels')
         self.weakly_labeled_image_paths = list(predictions_dict.keys())
         self.weakly_labeled_targets = predictions_dict
+        self.weak_class_frequencies = np.zeros(self.NUM_CLASSES, dtype=np.int64)
+        for target in predictions_dict.values():
+            self.weak_class_frequencies += label_histogram(target, self.NUM_CLASSES)
 
     def clear_weak_labels(self):
         self.weakly_labeled_targets = {}
         self.weakly_labeled_image_paths = []
+        self.weak_class_frequencies = np.zeros(self.NUM_CLASSES, dtype=np.int64)
 
 
 if __name__ == '__main__':
@@ -3,6 +3,8 @@ from dataloaders import custom_transforms as tr
 from torch.utils import data
 import lmdb
 import pickle
+import numpy as np
+from utils.calculate_weights import label_histogram
 import os
 import random
 
@@ -80,6 +82,12 @@ class ActivePascalBase(PascalBase):
         self.current_image_paths = []
         self.weakly_labeled_image_paths = []
         self.weakly_labeled_targets = {}
+        self.class_histograms = self._load_stored_class_histograms()
+        self.labeled_class_frequencies = None
+        self.weak_class_frequencies = np.zeros(self.NUM_CLASSES, dtype=np.int64)
+        # images are identified by their position in image_paths, membership in the labeled set is a mask over them
+        self.path_to_id = {path: idx for idx, path in enumerate(self.image_paths)}
+        self.labeled_mask = np.zeros(len(self.image_paths), dtype=np.bool_)
 
     def __len__(self):
         return len(self.current_image_paths) + len(self.weakly_labeled_image_paths)
@@ -102,6 +110,35 @@ class ActivePascalBase(PascalBase):
         self.current_image_paths = self.current_image_paths[:self.original_size_current]
         self.weakly_labeled_image_paths = self.weakly_labeled_image_paths[:self.original_size_weakly_labeled]
 
+    def get_ids(self, paths):
+        return np.array([self.path_to_id[path] for path in paths], dtype=np.int64)
+
+    def get_paths(self, ids):
+        return [self.image_paths[idx] for idx in ids]
+
+    def get_remaining_ids(self):
+        return np.nonzero(~self.labeled_mask)[0]
+
+    def _load_stored_class_histograms(self):
+        # written by the lmdb conversion scripts, older databases compute histograms on demand
+        with self.env.begin(write=False) as txn:
+            stored = txn.get(b'__class_histograms__')
+        return pickle.loads(stored) if stored is not None else {}
+
+    def get_class_histogram(self, path):
+        if path not in self.class_histograms:
+            with self.env.begin(write=False) as txn:
+                self.class_histograms[path] = label_histogram(pickle.loads(txn.get(path))[:, :, 3], self.NUM_CLASSES)
+        return self.class_histograms[path]
+
+    def get_class_frequencies(self):
+        # pixels per class over the labeled and weakly labeled images, kept up to date as the sets change
+        if self.labeled_class_frequencies is None:
+            self.labeled_class_frequencies = np.zeros(self.NUM_CLASSES, dtype=np.int64)
+            for path in dict.fromkeys(self.current_image_paths):
+                self.labeled_class_frequencies += self.get_class_histogram(path)
+        return self.labeled_class_frequencies + self.weak_class_frequencies
+
     def get_fraction_of_labeled_data(self):
         return self.labeled_pixel_count / (len(self.image_paths) * self.base_size * self.base_size)
 
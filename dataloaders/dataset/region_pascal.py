@@ -5,10 +5,13 @@ from dataloaders.dataset import pascal_base
 from dataloaders.dataset import active_pascal
 from collections import OrderedDict
 from utils.cityscapes_to_lmdb import CITYSCAPES_IGNORE_INDEX
+from utils.superpixels import open_superpixel_env, load_superpixels
 import constants
 import os
 from dataloaders import custom_transforms as tr
+from torchvision import transforms
 from tqdm import tqdm
+from utils.calculate_weights import label_histogram
 
 
 class ActivePascalRegion(pascal_base.ActivePascalBase):
@@ -17,7 +20,19 @@ class ActivePascalRegion(pascal_base.ActivePascalBase):
     def __init__(self, path, base_size, crop_size, split, init_set, overfit=False, memory_hog_mode=True):
 
         super(ActivePascalRegion, self).__init__(path, base_size, crop_size, split, overfit)
+        # train labels are masked and scaled once per image and cached, so only the image goes through the scale/crop.
+        # val images are fully labeled and read their raw targets
+        self.label_scalecrop = self.scalecrop
+        if self.split == 'train':
+            self.scalecrop = tr.ScaleCropWithPrescaledLabel(tr.FixScaleCropImageOnly(crop_size=self.crop_size) if self.crop_size != -1 else tr.ScaleWithPaddingImageOnly(base_size=self.base_size))
+        self.path_to_target = {}
+        # histograms of the masked targets, i.e. only of labeled regions and superpixels
+        self.labeled_class_frequencies = np.zeros(self.NUM_CLASSES, dtype=np.int64)
+        self.path_to_superpixel_bounds = {}
+        self.region_crops = None
         self.current_paths_to_regions_map = OrderedDict({})
+        self.current_paths_to_superpixels_map = OrderedDict({})
+        self.superpixel_env = None
         if self.split == 'train':
             with open(os.path.join(self.path, 'seed_sets', init_set), "r") as fptr:
                 for path in fptr.readlines():
@@ -35,6 +50,8 @@ class ActivePascalRegion(pascal_base.ActivePascalBase):
             self.load_files_into_memory()
 
         self._update_path_lists()
+        if self.split == 'train':
+            self._cache_masked_targets(self.current_image_paths)
         self.labeled_pixel_count = base_size * base_size * len(self.current_image_paths)
         print(f'# of current_image_paths = {len(self.current_image_paths)}')
 
@@ -46,10 +63,111 @@ class ActivePascalRegion(pascal_base.ActivePascalBase):
                 self.current_paths_to_regions_map[path] = regions
         self.labeled_pixel_count += labeled_pixels
         self._update_path_lists()
+        self._cache_masked_targets(list(new_regions.keys()))
+        if self.region_crops is not None:
+            self._update_region_crops()
+
+    def expand_training_set_with_superpixels(self, new_superpixels, labeled_pixels):
+        for path, superpixels in new_superpixels.items():
+            if path in self.current_paths_to_superpixels_map:
+                self.current_paths_to_superpixels_map[path].extend(superpixels)
+            else:
+                self.current_paths_to_superpixels_map[path] = superpixels
+            if path not in self.current_paths_to_regions_map:
+                self.current_paths_to_regions_map[path] = []
+        self.labeled_pixel_count += labeled_pixels
+        self._update_path_lists()
+        self._cache_masked_targets(list(new_superpixels.keys()))
+        if self.region_crops is not None:
+            self._update_region_crops()
+
+    def get_superpixel_env(self):
+        if self.superpixel_env is None:
+            self.superpixel_env = open_superpixel_env(self.path, self.split)
+        return self.superpixel_env
+
+    def _cache_masked_targets(self, paths):
+        for path in tqdm(paths, desc='Caching masked targets'):
+            loaded_npy = self._load_npy(path)
+            target_full = loaded_npy[:, :, 3]
+            target_masked = np.ones(target_full.shape, dtype=target_full.dtype) * CITYSCAPES_IGNORE_INDEX
+            for r in self.current_paths_to_regions_map[path]:
+                tr.invert_scale_crop(target_full, target_masked, r, self.base_size)
+            target = self.label_scalecrop({'image': loaded_npy[:, :, 0:3], 'label': target_masked})['label']
+            self.path_to_superpixel_bounds.pop(path, None)
+            if path in self.current_paths_to_superpixels_map:
+                # superpixels are stored in the scaled space, so they are copied over after scaling
+                superpixel_mask = np.isin(load_superpixels(self.get_superpixel_env(), path), self.current_paths_to_superpixels_map[path])
+                target[superpixel_mask] = self.label_scalecrop({'image': loaded_npy[:, :, 0:3], 'label': target_full})['label'][superpixel_mask]
+                rows, cols = np.nonzero(superpixel_mask)
+                if len(rows) > 0:
+                    self.path_to_superpixel_bounds[path] = (rows.min(), cols.min(), rows.max() - rows.min() + 1, cols.max() - cols.min() + 1)
+            if path in self.path_to_target:
+                self.labeled_class_frequencies -= label_histogram(self.path_to_target[path], self.NUM_CLASSES)
+            self.labeled_class_frequencies += label_histogram(target, self.NUM_CLASSES)
+            self.path_to_target[path] = target
+
+    def set_region_crop_mode(self, region_size, margin):
+        assert self.split == 'train', 'region crops are only used for training'
+        self.region_crop_size = region_size
+        self.region_crop_margin = margin
+        self._update_region_crops()
+
+    def _update_region_crops(self):
+        self.region_crops = []
+        for path in self.current_image_paths:
+            regions = self.current_paths_to_regions_map[path]
+            if path in self.path_to_superpixel_bounds:
+                regions = regions + [self.path_to_superpixel_bounds[path]]
+            for window, core in tr.get_region_crop_windows(regions, self.region_crop_size,
+                                                           self.region_crop_margin, self.path_to_target[path].shape):
+                self.region_crops.append((path, window, core))
+        print(f'# of region crops = {len(self.region_crops)}')
+
+    def __len__(self):
+        if self.region_crops is not None:
+            return len(self.region_crops)
+        return super().__len__()
+
+    def make_dataset_multiple_of_batchsize(self, batch_size):
+        super().make_dataset_multiple_of_batchsize(batch_size)
+        if self.region_crops is not None:
+            self.original_size_region_crops = len(self.region_crops)
+            self.region_crops = self._fix_list_multiple_of_batch_size(self.region_crops, batch_size)
+
+    def reset_dataset(self):
+        super().reset_dataset()
+        if self.region_crops is not None:
+            self.region_crops = self.region_crops[:self.original_size_region_crops]
+
+    def transform_region_crop(self, sample, window, core):
+
+        composed_transforms = transforms.Compose([
+            self.scalecrop,
+            tr.RegionCrop(window, core, ignore_index=CITYSCAPES_IGNORE_INDEX),
+            tr.RandomHorizontalFlip(),
+            tr.RandomGaussianBlur(),
+            tr.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            tr.ToTensor()
+        ])
+
+        return composed_transforms(sample)
 
     def _update_path_lists(self):
         assert len(self.current_image_paths) == len(list(set(self.current_image_paths))), "updating expanded list"
         self.current_image_paths = list(self.current_paths_to_regions_map.keys())
+        # an image counts as labeled as soon as any of its regions or superpixels is
+        self.labeled_mask[:] = False
+        self.labeled_mask[self.get_ids([x for x in self.current_image_paths if x in self.path_to_id])] = True
+
+    def get_existing_superpixel_maps(self):
+        superpixels = []
+        for path in self.image_paths:
+            if path in self.current_paths_to_superpixels_map:
+                superpixels.append(self.current_paths_to_superpixels_map[path])
+            else:
+                superpixels.append([])
+        return superpixels
 
     def get_existing_region_maps(self):
         regions = []
@@ -68,29 +186,24 @@ class ActivePascalRegion(pascal_base.ActivePascalBase):
                     loaded_npy = pickle.loads(txn.get(n))
                     self.path_to_npy[n] = loaded_npy
 
-    def __getitem__(self, index):
-
-        img_path = None
-        regions = None
-
-        img_path, regions = self.current_image_paths[index], self.current_paths_to_regions_map[self.current_image_paths[index]]
-
-        loaded_npy = None
+    def _load_npy(self, img_path):
         if self.memory_hog_mode and img_path in self.path_to_npy:
-            loaded_npy = self.path_to_npy[img_path]
-        else:
-            with self.env.begin(write=False) as txn:
-                loaded_npy = pickle.loads(txn.get(img_path))
+            return self.path_to_npy[img_path]
+        with self.env.begin(write=False) as txn:
+            return pickle.loads(txn.get(img_path))
 
-        image = loaded_npy[:, :, 0:3]
-        target_full = loaded_npy[:, :, 3]
+    def __getitem__(self, index):
 
-        target_masked = np.ones(target_full.shape, dtype=target_full.dtype) * CITYSCAPES_IGNORE_INDEX
+        if self.region_crops is not None:
+            img_path, window, core = self.region_crops[index]
+            sample = {'image': self._load_npy(img_path)[:, :, 0:3], 'label': self.path_to_target[img_path]}
+            return self.transform_region_crop(sample, window, core)
 
-        for r in regions:
-            tr.invert_scale_crop(target_full, target_masked, r, self.base_size)
+        img_path = self.current_image_paths[index]
+        loaded_npy = self._load_npy(img_path)
 
-        sample = {'image': image, 'label': target_masked}
+        target = self.path_to_target[img_path] if self.split == 'train' else loaded_npy[:, :, 3]
+        sample = {'image': loaded_npy[:, :, 0:3], 'label': target}
         return self.get_transformed_sample(sample)
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ import torch.nn as nn
 import math
 from models.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
 import torch.utils.model_zoo as model_zoo
+from models.backbone.pretrained import load_pretrained_state
 import constants
 import json
 import os
@@ -145,7 +146,7 @@ class MobileNetV2(nn.Module):
 
     def _load_pretrained_model(self):
 
-        pretrain_dict = model_zoo.load_url('http://jeff95.me/models/mobilenet_v2-6a65762b.pth')
+        pretrain_dict = load_pretrained_state('http://jeff95.me/models/mobilenet_v2-6a65762b.pth')
         model_dict = {}
         state_dict = self.state_dict()
 
@@ -0,0 +1,10 @@
+import torch.utils.model_zoo as model_zoo
+
+# pretrained weights by url, so that models rebuilt within a process (every active iteration) skip deserialization
+_pretrained_state_cache = {}
+
+
+def load_pretrained_state(url):
+    if url not in _pretrained_state_cache:
+        _pretrained_state_cache[url] = model_zoo.load_url(url, map_location='cpu')
+    return _pretrained_state_cache[url]
@@ -1,6 +1,7 @@
 import math
 import torch.nn as nn
 import torch.utils.model_zoo as model_zoo
+from models.backbone.pretrained import load_pretrained_state
 from models.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
 
 class Bottleneck(nn.Module):
@@ -146,7 +147,7 @@ class ResNet(nn.Module):
 
 	def _load_pretrained_model(self):
 		# pretrain_dict = model_zoo.load_url('https://download.pytorch.org/models/resnet101-5d3b4d8f.pth')
-		pretrain_dict = model_zoo.load_url('https://download.pytorch.org/models/resnet50-19c8e357.pth')
+		pretrain_dict = load_pretrained_state('https://download.pytorch.org/models/resnet50-19c8e357.pth')
 		
 		model_dict = {}
 		state_dict = self.state_dict()
@@ -0,0 +1,116 @@
+import torch
+
+
+def _is_out_of_memory(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or (isinstance(e, RuntimeError) and 'out of memory' in str(e))
+
+
+def _max_difference(a, b):
+    if isinstance(a, (tuple, list)):
+        return max([_max_difference(x, y) for x, y in zip(a, b)])
+    return ((a.float() - b.float()).abs().max() / b.float().abs().max().clamp(min=1)).item()
+
+
+class InferenceModel:
+    """Selection view of a trained (DataParallel) model: channels_last layout and optionally torch.compile.
+
+    Behaves like the wrapped model for the selectors (call, eval, train, apply and .module). The first deterministic
+    batch of every output signature (logits or features, input shape) is also run by the eager model, and the wrapper
+    falls back to eager NCHW inference if the outputs differ by more than tolerance (relative to the largest output) or
+    if the optimized model fails. Out of memory errors are raised as usual. release() restores the contiguous layout of
+    the weights before training continues, acquire() converts them again.
+    """
+
+    def __init__(self, model, channels_last=True, compile=False, tolerance=1e-3):
+        self.model = model
+        self.module = model.module if hasattr(model, 'module') else model
+        self.channels_last = channels_last
+        self.tolerance = tolerance
+        self.is_optimized = True
+        self.checked_signatures = set()
+        self.forward = model
+        self.acquire()
+        if compile:
+            if hasattr(torch, 'compile'):
+                self.forward = torch.compile(model)
+            else:
+                print('torch.compile is not available, selection runs eagerly')
+
+    def _fall_back(self, reason):
+        print(f'Optimized inference disabled ({reason}), selection runs eagerly')
+        self.release()
+        self.channels_last = False
+        self.forward = self.model
+        self.is_optimized = False
+
+    def _optimized(self, inputs):
+        if self.channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        return self.forward(inputs)
+
+    def _is_deterministic(self):
+        # mc dropout turns dropout layers back to train mode, feature noise is a flag on the model
+        return not getattr(self.module, 'noisy_features', False) and not any(m.training for m in self.module.modules())
+
+    def _signature(self, inputs):
+        # return_features changes the outputs and the compiled graph, every mode is checked separately
+        return getattr(self.module, 'return_features', False), tuple(inputs.shape[1:])
+
+    def __call__(self, inputs):
+        if not self.is_optimized:
+            return self.model(inputs)
+        try:
+            outputs = self._optimized(inputs)
+        except Exception as e:
+            if _is_out_of_memory(e):
+                raise
+            self._fall_back(f'{type(e).__name__}: {e}')
+            return self.model(inputs)
+        signature = self._signature(inputs)
+        if signature in self.checked_signatures or not self._is_deterministic():
+            return outputs
+        with torch.no_grad():
+            difference = _max_difference(outputs, self.model(inputs.contiguous()))
+        self.checked_signatures.add(signature)
+        if difference > self.tolerance:
+            self._fall_back(f'outputs differ from eager by {difference:.2e} for {signature}')
+            return self.model(inputs)
+        print(f'Optimized inference matches eager outputs for {signature} (max relative difference {difference:.2e})')
+        return outputs
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def train(self, mode=True):
+        self.model.train(mode)
+        return self
+
+    def apply(self, fn):
+        self.model.apply(fn)
+        return self
+
+    def acquire(self):
+        if self.channels_last:
+            self.module.to(memory_format=torch.channels_last)
+
+    def release(self):
+        if self.channels_last:
+            self.module.to(memory_format=torch.contiguous_format)
+
+
+_cached_inference_model = {}
+
+
+def get_inference_model(model, checkpoint_key, channels_last=True, compile=False):
+    """One wrapper per model and checkpoint, e.g. (experiment directory, best mIoU). A new checkpoint releases the
+    previous wrapper, so compiled graphs and checks are redone only when the weights change."""
+    key = (id(model), checkpoint_key, channels_last, compile)
+    if _cached_inference_model.get('key') != key:
+        if 'model' in _cached_inference_model:
+            _cached_inference_model['model'].release()
+        _cached_inference_model['key'] = key
+        _cached_inference_model['model'] = InferenceModel(model, channels_last=channels_last, compile=compile)
+    else:
+        _cached_inference_model['model'].acquire()
+    return _cached_inference_model['model']
@@ -11,6 +11,7 @@ from models.enet import ENet
 from models.fastscnn import FastSCNN
 from utils.loss import SegmentationLosses
 from utils.calculate_weights import calculate_weights_labels
+from utils import amp
 from utils.lr_scheduler import LR_Scheduler
 from utils.saver import PassiveSaver
 from utils.summaries import TensorboardSummary
@@ -81,6 +82,9 @@ class Trainer(object):
             patch_replication_callback(self.model)
             self.model = self.model.cuda()
 
+        self.device_type = 'cuda' if args.cuda else 'cpu'
+        self.scaler = amp.make_grad_scaler(args.amp, self.device_type)
+
         self.best_pred = 0.0
         if args.resume is not None:
             if not os.path.isfile(args.resume):
@@ -102,6 +106,8 @@ class Trainer(object):
         self.model.train()
         num_img_tr = len(self.train_loader)
         tbar = tqdm(self.train_loader, desc='\r')
+        throughput = amp.ThroughputMeter(self.args.cuda)
+        throughput.start()
 
         visualization_index = int(random.random() * len(self.val_loader))
         vis_img = None
@@ -117,10 +123,15 @@ class Trainer(object):
                 self.writer.add_scalar('train/learning_rate', self.scheduler.current_lr, i + num_img_tr * epoch)
 
             self.optimizer.zero_grad()
-            output = self.model(image)
+            with amp.autocast(self.args.amp, self.device_type):
+                output = self.model(image)
+            # the loss is reduced in float32
+            output = output.float()
             loss = self.criterion(output, target)
-            loss.backward()
-            self.optimizer.step()
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            throughput.update(image.shape[0])
             train_loss += loss.item()
             tbar.set_description('Train loss: %.3f' % (train_loss / (i + 1)))
             self.writer.add_scalar('train/total_loss_iter', loss.item(), i + num_img_tr * epoch)
@@ -130,6 +141,9 @@ class Trainer(object):
                 vis_tgt = target
                 vis_out = output
 
+        images_per_second, peak_memory_gb = throughput.stop()
+        self.writer.add_scalar('train/images_per_second', images_per_second, epoch)
+        self.writer.add_scalar('train/peak_memory_gb', peak_memory_gb, epoch)
         self.writer.add_scalar('train/total_loss_epoch', train_loss, epoch)
         self.summary.visualize_image(self.writer, self.args.dataset, vis_img, vis_tgt, vis_out, epoch, prefix='train')
 
@@ -167,7 +181,7 @@ class Trainer(object):
                 image, target = image.cuda(), target.cuda()
 
             with torch.no_grad():
-                output = self.model(image)
+                output = amp.forward(self.model, image, self.args.amp, self.device_type)
 
             if i == visualization_index:
                 vis_img = image
@@ -177,9 +191,7 @@ class Trainer(object):
             loss = self.criterion(output, target)
             test_loss += loss.item()
             tbar.set_description('Test loss: %.3f' % (test_loss / (i + 1)))
-            pred = output.data.cpu().numpy()
-            target = target.cpu().numpy()
-            pred = np.argmax(pred, axis=1)
+            pred = output.argmax(1)
             self.evaluator.add_batch(target, pred)
 
         # Fast test during the training
@@ -265,6 +277,8 @@ def main():
     parser.add_argument('--nesterov', action='store_true', default=False,
                         help='whether use nesterov (default: False)')
     # cuda, seed and logging
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='mixed precision, float16 with loss scaling on gpu, bfloat16 on cpu')
     parser.add_argument('--no-cuda', action='store_true', default=False, help='disables CUDA training')
     parser.add_argument('--gpu-ids', type=str, default='0',
                         help='use which gpu to train, must be a \
@@ -0,0 +1,54 @@
+import contextlib
+import time
+import torch
+
+
+def autocast(enabled, device_type='cuda'):
+    # float16 on the gpu, bfloat16 on the cpu where float16 kernels are slow or missing
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=torch.float16 if device_type == 'cuda' else torch.bfloat16)
+
+
+def make_grad_scaler(enabled, device_type='cuda'):
+    # a disabled scaler passes losses and optimizer steps through unchanged, bfloat16 needs no scaling
+    return torch.amp.GradScaler('cuda', enabled=enabled and device_type == 'cuda')
+
+
+def to_float(outputs):
+    if isinstance(outputs, tuple):
+        return tuple(to_float(o) for o in outputs)
+    return outputs.float()
+
+
+def forward(model, inputs, enabled, device_type='cuda'):
+    """Runs model under autocast and returns its outputs in float32, so that softmax, entropies and losses computed
+    from them stay in full precision."""
+    with autocast(enabled, device_type):
+        outputs = model(inputs)
+    return to_float(outputs) if enabled else outputs
+
+
+class ThroughputMeter:
+    """Images per second and peak gpu memory between start() and stop()."""
+
+    def __init__(self, cuda):
+        self.cuda = cuda
+        self.num_images = 0
+
+    def start(self):
+        self.num_images = 0
+        if self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        self.start_time = time.time()
+
+    def update(self, num_images):
+        self.num_images += num_images
+
+    def stop(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        elapsed = time.time() - self.start_time
+        peak_memory_gb = torch.cuda.max_memory_allocated() / 1024 ** 3 if self.cuda else 0
+        return self.num_images / elapsed if elapsed > 0 else 0, peak_memory_gb
@@ -0,0 +1,99 @@
+import numpy as np
+import math
+import time
+from sklearn.metrics import pairwise_distances
+
+
+class IVFIndex:
+    """Inverted file index: a k-means coarse quantizer splits the data into n_lists lists and a query is compared
+    exactly against the members of its nprobe closest lists only. nprobe = n_lists is an exact search."""
+
+    def __init__(self, n_lists=None, nprobe=8, block_size=4096, seed=0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.block_size = block_size
+        self.seed = seed
+
+    def fit(self, data):
+        from sklearn.cluster import MiniBatchKMeans
+
+        self.data = np.asarray(data, dtype=np.float32)
+        n_lists = self.n_lists if self.n_lists else int(math.sqrt(len(self.data)))
+        n_lists = max(1, min(n_lists, len(self.data)))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=self.seed, batch_size=max(1024, 4 * n_lists), n_init=3)
+        assignments = kmeans.fit_predict(self.data)
+        self.centroids = kmeans.cluster_centers_.astype(np.float32)
+        self.lists = [np.nonzero(assignments == l)[0] for l in range(n_lists)]
+        return self
+
+    def query(self, queries, k=1):
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self.data))
+        nprobe = min(self.nprobe, len(self.lists))
+        best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        probes = np.zeros((len(queries), nprobe), dtype=np.int64)
+        for start in range(0, len(queries), self.block_size):
+            centroid_distances = pairwise_distances(queries[start: start + self.block_size], self.centroids)
+            probes[start: start + self.block_size] = np.argpartition(centroid_distances, nprobe - 1, axis=1)[:, :nprobe]
+        # scan list by list so that every distance block is a vectorized (queries probing l) x (members of l) product
+        probing_queries = np.argsort(probes.ravel(), kind='stable') // nprobe
+        list_starts = np.searchsorted(np.sort(probes.ravel()), np.arange(len(self.lists) + 1))
+        for l, members in enumerate(self.lists):
+            query_indices = probing_queries[list_starts[l]: list_starts[l + 1]]
+            if len(members) == 0 or len(query_indices) == 0:
+                continue
+            for start in range(0, len(query_indices), self.block_size):
+                block = query_indices[start: start + self.block_size]
+                distances = pairwise_distances(queries[block], self.data[members]).astype(np.float32)
+                candidate_distances = np.concatenate([best_distances[block], distances], axis=1)
+                candidate_indices = np.concatenate([best_indices[block], np.broadcast_to(members, distances.shape)], axis=1)
+                top = np.argsort(candidate_distances, axis=1, kind='stable')[:, :k]
+                best_distances[block] = np.take_along_axis(candidate_distances, top, axis=1)
+                best_indices[block] = np.take_along_axis(candidate_indices, top, axis=1)
+        return best_distances, best_indices
+
+
+class BallTreeIndex:
+    """Exact nearest neighbours from sklearn's ball tree, fast for low dimensional (e.g. projected) features."""
+
+    def __init__(self, leaf_size=40):
+        self.leaf_size = leaf_size
+
+    def fit(self, data):
+        from sklearn.neighbors import BallTree
+
+        self.data = np.asarray(data, dtype=np.float32)
+        self.tree = BallTree(self.data, leaf_size=self.leaf_size)
+        return self
+
+    def query(self, queries, k=1):
+        distances, indices = self.tree.query(np.asarray(queries, dtype=np.float32), k=min(k, len(self.data)))
+        return distances.astype(np.float32), indices
+
+
+def build_ann_index(backend, data, n_lists=None, nprobe=8):
+    start_time = time.time()
+    if backend == 'ivf':
+        index = IVFIndex(n_lists=n_lists, nprobe=nprobe).fit(data)
+    elif backend == 'balltree':
+        index = BallTreeIndex().fit(data)
+    else:
+        raise NotImplementedError
+    print(f'Built {backend} index over {len(data)} points in {time.time() - start_time:.2f}s')
+    return index
+
+
+def measure_recall(index, queries, k=1, sample_size=256, seed=0):
+    """recall@k of the index against a brute force search, on a random sample of the queries"""
+    queries = np.asarray(queries, dtype=np.float32)
+    if sample_size <= 0 or len(queries) == 0:
+        return None
+    rng = np.random.RandomState(seed)
+    sample = queries[rng.choice(len(queries), min(sample_size, len(queries)), replace=False)]
+    k = min(k, len(index.data))
+    exact = np.argsort(pairwise_distances(sample, index.data), axis=1, kind='stable')[:, :k]
+    _, approximate = index.query(sample, k)
+    recall = np.mean([len(set(exact[i]) & set(approximate[i])) / k for i in range(len(sample))])
+    print(f'ANN recall@{k} on {len(sample)} queries = {recall:.4f}')
+    return recall
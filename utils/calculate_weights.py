@@ -4,6 +4,12 @@ import numpy as np
 from constants import DATASET_ROOT
 
 
+def label_histogram(label, num_classes):
+    label = np.asarray(label)
+    mask = np.logical_and((label >= 0), (label < num_classes))
+    return np.bincount(label[mask].astype(np.int64), minlength=num_classes)
+
+
 def calculate_weights_labels(dataset, dataloader, num_classes):
 
     z = np.zeros((num_classes,))
@@ -16,7 +22,12 @@ def calculate_weights_labels(dataset, dataloader, num_classes):
         labels = y[mask].astype(np.uint8)
         count_l = np.bincount(labels, minlength=num_classes)
         z += count_l
-    z = np.log(z)
+    return calculate_weights_from_frequencies(z)
+
+
+def calculate_weights_from_frequencies(class_frequencies):
+
+    z = np.log(np.asarray(class_frequencies, dtype=np.float64))
     total_frequency = np.sum(z)
     class_weights = []
 
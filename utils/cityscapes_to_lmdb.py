@@ -6,6 +6,7 @@ from PIL import Image
 from pathlib import Path
 from tqdm import tqdm
 import numpy as np
+from utils.calculate_weights import label_histogram
 
 CITYSCAPES_IGNORE_INDEX = 255
 
@@ -36,6 +37,7 @@ def cityscapes_to_lmdb(root_path, split, lmdb_path):
     txn = db.begin(write=True)
 
     key_list = []
+    class_histograms = {}
 
     for idx, datasample in tqdm(enumerate(zip(image_paths, label_paths))):
         image = np.array(Image.open(datasample[0]).convert('RGB'), dtype=np.uint8)
@@ -44,6 +46,7 @@ def cityscapes_to_lmdb(root_path, split, lmdb_path):
         label[:, :] = mapper(label)
         path_to_image = "/".join(datasample[0].replace(root_path, '').split(os.path.sep))
         txn.put(u'{}'.format(path_to_image).encode('ascii'), pickle.dumps(np.dstack((image, label)), protocol=3))
+        class_histograms[u'{}'.format(path_to_image).encode('ascii')] = label_histogram(label, NUM_CLASSES)
         key_list.append(path_to_image)
 
     txn.commit()
@@ -53,6 +56,8 @@ def cityscapes_to_lmdb(root_path, split, lmdb_path):
     with db.begin(write=True) as txn:
         txn.put(b'__keys__', pickle.dumps(keys, protocol=3))
         txn.put(b'__len__', pickle.dumps(len(keys), protocol=3))
+        # per image label histograms, for class weights without decoding labels
+        txn.put(b'__class_histograms__', pickle.dumps(class_histograms, protocol=3))
 
     db.sync()
     db.close()
@@ -0,0 +1,45 @@
+import torch
+import numpy as np
+
+
+def get_distance_device():
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def to_feature_tensor(features, device, half_precision=False):
+    # features are stored in float16/float32 and upcast block by block when distances are computed
+    dtype = torch.float16 if half_precision else torch.float32
+    if isinstance(features, torch.Tensor):
+        return features.to(device=device, dtype=dtype)
+    return torch.from_numpy(np.asarray(features, dtype=np.float32)).to(device=device, dtype=dtype)
+
+
+def squared_norms(features, block_size=2048):
+    norms = torch.zeros(features.shape[0], dtype=torch.float32, device=features.device)
+    for start in range(0, features.shape[0], block_size):
+        block = features[start: start + block_size].float()
+        norms[start: start + block_size] = (block * block).sum(dim=1)
+    return norms
+
+
+def euclidean_distances(a, b, a_squared_norms, b_squared_norms):
+    # ||a||^2 + ||b||^2 - 2ab, clamped since rounding can make it slightly negative
+    distances = a_squared_norms.unsqueeze(1) + b_squared_norms.unsqueeze(0) - 2 * torch.mm(a, b.t())
+    return distances.clamp_(min=0).sqrt_()
+
+
+def update_min_distances(features, feature_norms, center_indices, min_distances, block_size=2048):
+    """Fold the given centers into min_distances (distance of every feature to its closest center), block by block
+    so that at most block_size x block_size distances exist at a time."""
+
+    center_indices = torch.as_tensor(center_indices, dtype=torch.long, device=features.device)
+    for center_start in range(0, len(center_indices), block_size):
+        centers_block = center_indices[center_start: center_start + block_size]
+        centers = features[centers_block].float()
+        center_norms = feature_norms[centers_block]
+        for start in range(0, features.shape[0], block_size):
+            distances = euclidean_distances(features[start: start + block_size].float(), centers, feature_norms[start: start + block_size], center_norms)
+            min_distances[start: start + block_size] = torch.min(min_distances[start: start + block_size], distances.min(dim=1)[0])
+    # centers are at distance zero from themselves, independent of rounding
+    min_distances[center_indices] = 0
+    return min_distances
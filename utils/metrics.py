@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 # https://stats.stackexchange.com/questions/179835/how-to-build-a-confusion-matrix-for-a-multiclass-classifier
 
@@ -8,7 +9,21 @@ class Evaluator(object):
     def __init__(self, num_class):
         np.seterr(divide='ignore', invalid='ignore')
         self.num_class = num_class
-        self.confusion_matrix = np.zeros((self.num_class,) * 2)
+        self._confusion_matrix = np.zeros((self.num_class,) * 2)
+        # counts of tensor batches, accumulated where the tensors live and moved to the host when metrics are read
+        self._device_confusion_matrix = None
+
+    @property
+    def confusion_matrix(self):
+        if self._device_confusion_matrix is not None:
+            self._confusion_matrix += self._device_confusion_matrix.view(self.num_class, self.num_class).cpu().numpy()
+            self._device_confusion_matrix = None
+        return self._confusion_matrix
+
+    @confusion_matrix.setter
+    def confusion_matrix(self, value):
+        self._confusion_matrix = value
+        self._device_confusion_matrix = None
 
     def Pixel_Accuracy(self):
         return np.diag(self.confusion_matrix).sum() / self.confusion_matrix.sum()
@@ -41,9 +56,22 @@ class Evaluator(object):
         confusion_matrix = count.reshape(self.num_class, self.num_class)
         return confusion_matrix
 
+    def _generate_matrix_on_device(self, gt_image, pre_image):
+        mask = (gt_image >= 0) & (gt_image < self.num_class)
+        label = self.num_class * gt_image[mask].long() + pre_image[mask].long()
+        return torch.bincount(label, minlength=self.num_class**2)
+
     def add_batch(self, gt_image, pre_image):
+        # numpy arrays or tensors (e.g. targets and the argmax of the logits on the gpu)
         assert gt_image.shape == pre_image.shape
-        self.confusion_matrix += self._generate_matrix(gt_image, pre_image)
+        if torch.is_tensor(gt_image):
+            count = self._generate_matrix_on_device(gt_image, pre_image)
+            if self._device_confusion_matrix is None:
+                self._device_confusion_matrix = count
+            else:
+                self._device_confusion_matrix += count
+        else:
+            self._confusion_matrix += self._generate_matrix(gt_image, pre_image)
 
     def reset(self):
         self.confusion_matrix = np.zeros((self.num_class,) * 2)
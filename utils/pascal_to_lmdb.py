@@ -6,6 +6,7 @@ from PIL import Image
 from pathlib import Path
 from tqdm import tqdm
 import numpy as np
+from utils.calculate_weights import label_histogram
 
 
 def pascal_to_lmdb(root_path, split, lmdb_path):
@@ -39,6 +40,7 @@ def pascal_to_lmdb(root_path, split, lmdb_path):
     txn = db.begin(write=True)
 
     key_list = []
+    class_histograms = {}
 
     for idx, path in tqdm(enumerate(image_paths)):
         jpg_path = os.path.join(root_path, 'JPEGImages', f'{path}.jpg')
@@ -46,6 +48,7 @@ def pascal_to_lmdb(root_path, split, lmdb_path):
         image = np.array(Image.open(jpg_path).convert('RGB'), dtype=np.uint8)
         label = np.array(Image.open(png_path), dtype=np.uint8)
         txn.put(u'{}'.format(path).encode('ascii'), pickle.dumps(np.dstack((image, label)), protocol=3))
+        class_histograms[u'{}'.format(path).encode('ascii')] = label_histogram(label, NUM_CLASSES)
         key_list.append(path)
 
     txn.commit()
@@ -55,6 +58,8 @@ def pascal_to_lmdb(root_path, split, lmdb_path):
     with db.begin(write=True) as txn:
         txn.put(b'__keys__', pickle.dumps(keys, protocol=3))
         txn.put(b'__len__', pickle.dumps(len(keys), protocol=3))
+        # per image label histograms, for class weights without decoding labels
+        txn.put(b'__class_histograms__', pickle.dumps(class_histograms, protocol=3))
 
     db.sync()
     db.close()
@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+
+def stratified_subset(class_presence, size, seed=0):
+    """Indices of about size images such that every class gets a share of size / num_classes images containing it,
+    rarest classes first, filled up with random images."""
+    rng = np.random.RandomState(seed)
+    num_images, num_classes = class_presence.shape
+    size = min(size, num_images)
+    quota = max(1, size // num_classes)
+    is_selected = np.zeros(num_images, dtype=np.bool_)
+    for c in np.argsort(class_presence.sum(axis=0), kind='stable'):
+        missing = quota - class_presence[is_selected, c].sum()
+        candidates = np.nonzero(class_presence[:, c] & ~is_selected)[0]
+        if missing <= 0 or len(candidates) == 0:
+            continue
+        is_selected[rng.choice(candidates, min(missing, len(candidates), size - is_selected.sum()), replace=False)] = True
+    remaining = np.nonzero(~is_selected)[0]
+    is_selected[rng.choice(remaining, max(0, size - is_selected.sum()), replace=False)] = True
+    return np.nonzero(is_selected)[0].tolist()
+
+
+class ProxyValidation:
+    """Cheap validation on a fixed class stratified subset of the val split.
+
+    escalate() tells after every proxy evaluation whether the full split should be evaluated as well, which is the case
+    when the proxy mIoU is within margin of the best proxy mIoU of the current training round. Only full validations
+    choose checkpoints and report metrics.
+    """
+
+    def __init__(self, val_loader, num_classes, size, margin, seed=0):
+        class_presence = []
+        print('Collecting val class statistics for proxy validation..')
+        for sample in tqdm(val_loader):
+            for target in sample['label']:
+                target = target.long()
+                target = target[(target >= 0) & (target < num_classes)]
+                class_presence.append(torch.bincount(target, minlength=num_classes).numpy() > 0)
+        self.indices = stratified_subset(np.array(class_presence), size, seed)
+        self.loader = DataLoader(Subset(val_loader.dataset, self.indices), batch_size=val_loader.batch_size, shuffle=False,
+                                 num_workers=val_loader.num_workers)
+        self.margin = margin
+        self.best_proxy_mIoU = None
+        print(f'Proxy validation on {len(self.indices)}/{len(class_presence)} images')
+
+    def reset(self):
+        self.best_proxy_mIoU = None
+
+    def escalate(self, proxy_mIoU):
+        escalate = self.best_proxy_mIoU is None or proxy_mIoU >= self.best_proxy_mIoU - self.margin
+        if self.best_proxy_mIoU is None or proxy_mIoU > self.best_proxy_mIoU:
+            self.best_proxy_mIoU = proxy_mIoU
+        return escalate
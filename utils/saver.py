@@ -5,6 +5,82 @@ from collections import OrderedDict
 import glob
 import constants
 import json
+import io
+import queue
+import threading
+from utils import selection_handoff
+
+
+def _copy_to_host(obj):
+    if torch.is_tensor(obj):
+        # .cpu() already copies device tensors, only host tensors need a clone to be safe from further updates
+        return obj.detach().clone() if obj.device.type == 'cpu' else obj.detach().cpu()
+    if isinstance(obj, dict):
+        return obj.__class__((k, _copy_to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_copy_to_host(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread so that training does not wait for the disk.
+
+    submit() copies the state to host memory and queues it, the worker serializes it and writes every file to a
+    temporary file that is renamed over the target, so a reader never sees a partially written checkpoint. At most
+    max_pending snapshots are queued, submit() blocks beyond that. The worker exits when the queue is empty and is
+    restarted by the next submit(), so pending writes never keep a finished process alive.
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.error = None
+
+    def submit(self, files):
+        # files: filename -> state (saved with torch.save) or str, objects shared between files are serialized once
+        snapshots = {}
+        for obj in files.values():
+            if id(obj) not in snapshots:
+                snapshots[id(obj)] = _copy_to_host(obj)
+        files = {filename: snapshots[id(obj)] for filename, obj in files.items()}
+        self.queue.put(files)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.queue.empty():
+                    self.thread = None
+                    return
+            files = self.queue.get()
+            try:
+                serialized = {}
+                for filename, obj in files.items():
+                    if id(obj) not in serialized:
+                        if isinstance(obj, str):
+                            serialized[id(obj)] = obj.encode('utf-8')
+                        else:
+                            buffer = io.BytesIO()
+                            torch.save(obj, buffer)
+                            serialized[id(obj)] = buffer.getvalue()
+                    tmp_filename = filename + '.tmp'
+                    with open(tmp_filename, 'wb') as fptr:
+                        fptr.write(serialized[id(obj)])
+                    os.replace(tmp_filename, filename)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
 
 
 class Saver:
@@ -46,6 +122,7 @@ class ActiveSaver(Saver):
 
         super().__init__(args, experiment_group=experiment_group)
         self.experiment_dir = os.path.join(self.directory, f'run_{num_of_labeled_samples:04d}')
+        self.checkpoint_writer = CheckpointWriter()
 
         if not os.path.exists(self.experiment_dir):
             print(f'making dir {self.experiment_dir}')
@@ -53,29 +130,38 @@ class ActiveSaver(Saver):
 
     def save_checkpoint(self, state, is_best, filename='checkpoint.pth.tar'):
 
-        filename = os.path.join(self.experiment_dir, filename)
-        torch.save(state, filename)
-
+        # written in the background, call flush() before reading the files back
+        files = {os.path.join(self.experiment_dir, filename): state}
         if is_best:
-            best_pred = state['best_pred']
-            with open(os.path.join(self.experiment_dir, 'best_pred.txt'), 'w') as f:
-                f.write(str(best_pred))
-                f.write(f'\n{str(state["epoch"])}')
+            files[os.path.join(self.experiment_dir, 'best_pred.txt')] = f'{str(state["best_pred"])}\n{str(state["epoch"])}'
+            files[os.path.join(self.experiment_dir, 'best.pth.tar')] = state
+        self.checkpoint_writer.submit(files)
+
+    def flush(self):
+
+        self.checkpoint_writer.flush()
 
-            filename = os.path.join(self.experiment_dir, 'best.pth.tar')
-            torch.save(state, filename)
+    def save_active_selections(self, paths, regions, superpixels=None):
 
-    def save_active_selections(self, paths, regions):
+        if superpixels and any(superpixels):
+            filename = os.path.join(self.experiment_dir, 'superpixels.txt')
+            with open(filename, 'w') as fptr:
+                for p, segments in zip(paths, superpixels):
+                    if segments:
+                        fptr.write(p.decode('utf-8') + ',' + ",".join([str(i) for i in segments]) + '\n')
 
-        filename = os.path.join(self.experiment_dir, 'selections.txt')
+        # selections are published last and atomically, runs in accuracy_eval mode wait for them
+        if regions:
+            lines = [p.decode('utf-8') + ',' + ",".join([",".join([str(i) for i in r]) for r in region]) + '\n' for p, region in zip(paths, regions)]
+        else:
+            lines = [p.decode('utf-8') + '\n' for p in paths]
+        selection_handoff.publish(self.directory, os.path.join(self.experiment_dir, 'selections.txt'), lines)
+
+    def save_selection_report(self, report):
+
+        filename = os.path.join(self.experiment_dir, 'selection_report.json')
         with open(filename, 'w') as fptr:
-            if regions:
-                for p, region in zip(paths, regions):
-                    region_line = ",".join([",".join([str(i) for i in r]) for r in region])
-                    fptr.write(p.decode('utf-8') + ',' + region_line + '\n')
-            else:
-                for p in paths:
-                    fptr.write(p.decode('utf-8') + '\n')
+            fptr.write(json.dumps(report, indent=4))
 
 
 class PassiveSaver(Saver):
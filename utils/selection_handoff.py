@@ -0,0 +1,86 @@
+import os
+import socket
+import tempfile
+import time
+
+SOCKET_NAME = 'selections.sock'
+
+
+def write_atomic(filename, lines):
+    # readers either see no file or the complete file, never a partially written one
+    directory = os.path.dirname(filename)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as fptr:
+            fptr.writelines(lines)
+            fptr.flush()
+            os.fsync(fptr.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def notify_published(directory, filename):
+    """Tells a consumer waiting on the experiment directory that filename is available. Best effort, the consumer
+    falls back to checking for the file when no notification arrives."""
+    if not hasattr(socket, 'AF_UNIX'):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(os.path.abspath(filename).encode('utf-8'), os.path.join(directory, SOCKET_NAME))
+    except OSError:
+        # nobody waiting
+        pass
+    finally:
+        sock.close()
+
+
+def publish(directory, filename, lines):
+    write_atomic(filename, lines)
+    notify_published(directory, filename)
+
+
+def _bind_listener(directory):
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    socket_path = os.path.join(directory, SOCKET_NAME)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        sock.bind(socket_path)
+    except OSError:
+        # e.g. paths longer than the unix socket limit
+        sock.close()
+        return None
+    return sock
+
+
+def wait_for_publish(filename, directory=None, fallback_interval=5):
+    """Blocks until filename (published with publish()) exists. Wakes up on a notification for filename sent to
+    directory, which defaults to the experiment directory two levels above run_xxxx/selections.txt, and re-checks
+    every fallback_interval seconds otherwise."""
+    if directory is None:
+        directory = os.path.dirname(os.path.dirname(os.path.abspath(filename)))
+    os.makedirs(directory, exist_ok=True)
+    sock = _bind_listener(directory)
+    try:
+        while not os.path.exists(filename):
+            if sock is None:
+                time.sleep(fallback_interval)
+                continue
+            sock.settimeout(fallback_interval)
+            try:
+                # notifications for other iterations only trigger the existence check
+                sock.recv(4096)
+            except socket.timeout:
+                pass
+    finally:
+        if sock is not None:
+            sock.close()
+            try:
+                os.remove(os.path.join(directory, SOCKET_NAME))
+            except OSError:
+                pass
@@ -0,0 +1,62 @@
+import pickle
+import lmdb
+import os
+from tqdm import tqdm
+import numpy as np
+from dataloaders import custom_transforms as tr
+
+
+def get_superpixel_lmdb_path(path, split):
+    return os.path.join(path, split + "_superpixels.db")
+
+
+def open_superpixel_env(path, split):
+    return lmdb.open(get_superpixel_lmdb_path(path, split), subdir=False, readonly=True, lock=False, readahead=False, meminit=False)
+
+
+def load_superpixels(env, key):
+    with env.begin(write=False) as txn:
+        return pickle.loads(txn.get(key))
+
+
+def superpixels_to_lmdb(path, split, crop_size, base_size=512, n_segments=1000, compactness=10):
+    from skimage.segmentation import slic
+
+    # superpixels live in the same scaled space as the selection score maps (see PathsDataset)
+    if crop_size == -1:
+        scalecrop = tr.ScaleWithPaddingImageOnly(base_size=base_size)
+    else:
+        scalecrop = tr.FixScaleCropImageOnly(crop_size=crop_size)
+
+    source_env = lmdb.open(os.path.join(path, split + ".db"), subdir=False, readonly=True, lock=False, readahead=False, meminit=False)
+    with source_env.begin(write=False) as txn:
+        keys = pickle.loads(txn.get(b'__keys__'))
+
+    lmdb_path = get_superpixel_lmdb_path(path, split)
+    print("Generate LMDB to %s" % lmdb_path)
+    image_size = base_size if crop_size == -1 else crop_size
+    map_size = (len(keys) + 10) * image_size * image_size * 2 * 2
+    print("Estimated Size: ", map_size)
+    db = lmdb.open(lmdb_path, subdir=False, map_size=map_size, readonly=False, meminit=False, map_async=True)
+    txn = db.begin(write=True)
+
+    for key in tqdm(keys):
+        with source_env.begin(write=False) as source_txn:
+            image = pickle.loads(source_txn.get(key))[:, :, 0:3]
+        image = scalecrop(image).astype(np.uint8)
+        segments = slic(image, n_segments=n_segments, compactness=compactness, start_label=0)
+        txn.put(key, pickle.dumps(segments.astype(np.uint16), protocol=3))
+
+    txn.commit()
+
+    with db.begin(write=True) as txn:
+        txn.put(b'__keys__', pickle.dumps(keys, protocol=3))
+        txn.put(b'__len__', pickle.dumps(len(keys), protocol=3))
+
+    db.sync()
+    db.close()
+
+
+if __name__ == '__main__':
+    import sys
+    superpixels_to_lmdb(sys.argv[1], sys.argv[2], int(sys.argv[3]))
@@ -0,0 +1,39 @@
+import math
+
+
+class TrainingBudget:
+    """Training length of an active iteration in optimizer steps, growing sublinearly with the labeled set:
+
+        steps = clip(base_steps * (num_labeled / reference_size) ^ exponent, min_steps, max_steps)
+
+    num_labeled is the number of images with any labels, also for region datasets whose loaders iterate over region
+    crops, so that budgets are comparable across region and image modes. With exponent 0 every iteration costs the
+    same, with exponent 1 it matches a fixed number of epochs on image datasets. The reference size defaults to the
+    labeled set size of the first iteration that asks for a schedule.
+    """
+
+    def __init__(self, base_steps, reference_size=None, exponent=0.5, min_steps=None, max_steps=None, evaluations=10):
+        self.base_steps = base_steps
+        self.reference_size = reference_size
+        self.exponent = exponent
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.evaluations = evaluations
+
+    def steps(self, num_labeled):
+        if self.reference_size is None:
+            self.reference_size = num_labeled
+        steps = self.base_steps * (num_labeled / self.reference_size) ** self.exponent
+        if self.min_steps is not None:
+            steps = max(steps, self.min_steps)
+        if self.max_steps is not None:
+            steps = min(steps, self.max_steps)
+        return max(1, int(round(steps)))
+
+    def schedule(self, steps, steps_per_epoch):
+        """(epochs, eval_interval, steps) for training the given number of steps, validating about evaluations
+        times. The last epoch is cut short at steps."""
+        steps = max(1, int(round(steps)))
+        epochs = math.ceil(steps / steps_per_epoch)
+        eval_interval = max(1, math.ceil(epochs / self.evaluations))
+        return epochs, eval_interval, steps
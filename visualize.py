@@ -74,11 +74,9 @@ class Evaluations:
             loss = self.criterion(output, target)
             test_loss += loss.item()
             tbar.set_description('Test loss: %.3f' % (test_loss / (i + 1)))
-            pred = output.data.cpu().numpy()
-            target = target.cpu().numpy()
-            pred = np.argmax(pred, axis=1)
+            pred = output.argmax(1)
             self.evaluator.add_batch(target, pred)
-            TensorboardSummary.visualize_images_to_folder(self.visualizations_folder, i, image.cpu().numpy(), target, pred, self.args.dataset)
+            TensorboardSummary.visualize_images_to_folder(self.visualizations_folder, i, image.cpu().numpy(), target.cpu().numpy(), pred.cpu().numpy(), self.args.dataset)
 
         # Fast test during the training
         Acc = self.evaluator.Pixel_Accuracy()